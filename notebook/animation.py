@@ -0,0 +1,148 @@
+from pyqtgraph.Qt import QtCore
+
+class Animator(QtCore.QObject):
+    '''Drive a time-based animation from a QTimer.
+
+On each timer tick the current media time is read from the clock and passed
+to callback, so the animation runs in real time (scaled by rate) no matter how
+long callback takes. When rendering falls behind, the intermediate frames are
+dropped rather than queued. By default the clock is the wall clock, but it
+can be replaced by any callable that returns the current media time, e.g. the
+position of audio playback, or None when the clock has stopped.'''
+    sigStateChanged = QtCore.pyqtSignal(str)   # 'playing', 'paused' or 'stopped'
+    sigFps = QtCore.pyqtSignal(float)          # Achieved frames per second
+    sigFinished = QtCore.pyqtSignal()
+
+    def __init__(self, callback, interval=0.020, parent=None):
+        super(Animator, self).__init__(parent)
+        self.callback = callback  # Called with the media time of each frame.
+        self.interval = interval  # Target time between frames, in seconds.
+        self.rate = 1.0           # Playback rate.
+        self.t1 = None
+        self.t2 = None
+        self.clock = None
+        self.state = 'stopped'
+        self.fps = 0.0
+        self.fps_window = 0.5     # Seconds over which fps is measured.
+        self.nframes = 0          # Frames rendered since start()
+        self.ndropped = 0         # Frames dropped since start()
+        self._t_origin = None     # Media time when _elapsed was started.
+        self._elapsed = QtCore.QElapsedTimer()
+        self._fps_elapsed = QtCore.QElapsedTimer()
+        self._fps_nframes = 0
+        self._last_t = None
+        self.timer = QtCore.QTimer(self)
+        self.timer.setTimerType(QtCore.Qt.PreciseTimer)
+        self.timer.timeout.connect(self._tick)
+
+    @property
+    def position(self):
+        '''Return the current media time, or None if the clock has stopped.'''
+        if self.clock is not None:
+            return self.clock()
+        if self._t_origin is None:
+            return None
+        if self.state == 'playing':
+            return self._t_origin + self._elapsed.elapsed() * 1e-3 * self.rate
+        return self._t_origin
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.sigStateChanged.emit(state)
+
+    def start(self, t1, t2, clock=None):
+        '''Animate from media time t1 to t2. If clock is not None it is called
+to get the current media time instead of using the wall clock.'''
+        self.t1 = t1
+        self.t2 = t2
+        self.clock = clock
+        self.nframes = 0
+        self.ndropped = 0
+        self._last_t = None
+        self._t_origin = t1
+        self._elapsed.start()
+        self._fps_elapsed.start()
+        self._fps_nframes = 0
+        self._set_state('playing')
+        self.timer.start(int(self.interval * 1000))
+        self._tick()
+
+    def stop(self):
+        '''Stop the animation.'''
+        self.timer.stop()
+        self.clock = None
+        self._t_origin = None
+        self._set_state('stopped')
+
+    def pause(self):
+        '''Pause the animation at the current media time.'''
+        if self.state != 'playing' or self.clock is not None:
+            return
+        self._t_origin = self.position
+        self.timer.stop()
+        self._set_state('paused')
+
+    def resume(self):
+        '''Resume a paused animation.'''
+        if self.state != 'paused':
+            return
+        self._elapsed.start()
+        self._fps_elapsed.start()
+        self._fps_nframes = 0
+        self._set_state('playing')
+        self.timer.start(int(self.interval * 1000))
+
+    def toggle_pause(self):
+        '''Pause a playing animation or resume a paused one.'''
+        if self.state == 'playing':
+            self.pause()
+        elif self.state == 'paused':
+            self.resume()
+
+    def seek(self, t):
+        '''Move the animation to media time t.'''
+        if self.state == 'stopped' or self.clock is not None:
+            return
+        self._t_origin = min(max(t, self.t1), self.t2)
+        self._elapsed.start()
+        self._last_t = None
+        if self.state == 'paused':
+            self.callback(self._t_origin)
+
+    def set_rate(self, rate):
+        '''Set the playback rate, e.g. 0.5 for half speed.'''
+        if self.state == 'playing' and self.clock is None:
+            self._t_origin = self.position
+            self._elapsed.start()
+        self.rate = rate
+
+    def _tick(self):
+        '''Render the frame for the current media time.'''
+        t = self.position
+        if t is None or t >= self.t2:
+            if t is not None:  # Otherwise the clock stopped early.
+                self.callback(self.t2)
+            self._update_fps(final=True)
+            self.stop()
+            self.sigFinished.emit()
+            return
+        if self._last_t is not None:
+            step = self.interval * self.rate
+            if step > 0:
+                self.ndropped += max(int((t - self._last_t) / step) - 1, 0)
+        self._last_t = t
+        self.callback(t)
+        self.nframes += 1
+        self._fps_nframes += 1
+        self._update_fps()
+
+    def _update_fps(self, final=False):
+        '''Update and emit fps every fps_window seconds, or for the remaining
+frames if final is True.'''
+        fps_secs = self._fps_elapsed.elapsed() * 1e-3
+        if fps_secs >= self.fps_window or (final and self._fps_nframes > 0):
+            self.fps = self._fps_nframes / max(fps_secs, self.interval)
+            self.sigFps.emit(self.fps)
+            self._fps_elapsed.start()
+            self._fps_nframes = 0
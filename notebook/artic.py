@@ -1,7 +1,65 @@
-import re
+import re, warnings
 import numpy as np
 from pyqtgraph.Qt import QtGui
 import pyqtgraph as pg
+from animation import Animator
+from deriv import Derivatives
+from envelope import EnvelopePyramid, padded_view
+
+# Element lines and symbolBrushes used for EMA data.
+EMA_LINES = {
+    'tongue': {
+        'elements': ['TT', 'TB', 'TD'],
+        'pen': (128, 255, 128, 128)
+    },
+    'mouth': {
+        'elements': ['LL', 'UL'],
+        'pen': (128, 128, 255, 128)
+    }
+}
+EMA_BRUSHES = {
+    'TD': 'r',
+    'TB': 'r',
+    'TT': 'r',
+    'LL': 'y',
+    'UL': 'y',
+    'JW': 'k',
+    'UI': 'k',
+}
+
+def tslice(sec, t1, t2):
+    '''Return the start and stop indexes of the contiguous rows of the sorted
+array sec with t1 <= sec <= t2.'''
+    return (
+        np.searchsorted(sec, t1, side='left'),
+        np.searchsorted(sec, t2, side='right')
+    )
+
+def nearest_idx(sec, t):
+    '''Return the index of the value in the sorted array sec nearest t.'''
+    idx = np.searchsorted(sec, t)
+    if idx == len(sec) or (idx > 0 and t - sec[idx - 1] <= sec[idx] - t):
+        idx -= 1
+    return idx
+
+def frame_store(df, dims='xyz'):
+    '''Return the coordinate columns of df as a contiguous float32 array of
+shape (n_frames, n_elements, len(dims)), and the list of element names in the
+order of the second axis. Coordinate columns are named <element>_<dim>.
+Missing dims of an element are filled with NaN.'''
+    elre = re.compile(r'^(.+)_([{}])$'.format(dims))
+    elements = []
+    for c in df.columns:
+        m = elre.search(c)
+        if m and m.group(1) not in elements:
+            elements.append(m.group(1))
+    frames = np.full((len(df), len(elements), len(dims)), np.nan, dtype=np.float32)
+    for eidx, el in enumerate(elements):
+        for didx, d in enumerate(dims):
+            col = '{}_{}'.format(el, d)
+            if col in df.columns:
+                frames[:, eidx, didx] = df[col].values
+    return (frames, elements)
 
 class ArticuWidget(pg.GraphicsLayoutWidget):
     '''Widget that encapsulates element-based articulatory data, e.g. EMA,
@@ -23,36 +81,110 @@ x-ray microbeam.'''
 
     def set_selected_element_brushes(self):
 # TODO: don't hardcode default here
-        default = pg.mkBrush(color=(100, 100, 100, 255))
+        default = (100, 100, 100, 255)
         br = []
 # TODO: make sure self.elements is in same order as df columns
 # TODO: add logic for determining that an element is selected
         for el in self.elements:
-            try:
-                br.append(pg.mkBrush(color=self.brushes[el]))
-            except KeyError:
-                br.append(default)
+            if el in self._frame_elements:  # Only elements that are plotted
+                br.append(self._element_brush(el, default))
         self._selected_element_brushes = br
 
+    def _brush(self, color):
+        '''Return a brush of color. Brushes are created once per color and
+reused.'''
+        rgba = pg.mkColor(color).rgba()
+        try:
+            return self._brush_cache[rgba]
+        except KeyError:
+            br = pg.mkBrush(color=color)
+            self._brush_cache[rgba] = br
+            return br
+
+    def _element_brush(self, el, default=(128, 128, 128, 128)):
+        '''Return the brush of element el, or a brush of default color if el
+has no brush.'''
+        return self._brush(self.brushes.get(el, default))
+
+    def _plot_item(self, plot, key, cls=None, **kwargs):
+        '''Return the plot item registered as key, creating it in plot with
+plot.plot(**kwargs), or as cls(**kwargs) if cls is not None, if it doesn't
+exist yet. Items are created once and are updated with setData()
+afterwards.'''
+        try:
+            return self._items[key]
+        except KeyError:
+            if cls is None:
+                item = plot.plot(**kwargs)
+            else:
+                item = cls(**kwargs)
+                plot.addItem(item)
+            self._items[key] = item
+            return item
+
+    def _hide_plot_items(self):
+        '''Hide all registered plot items.'''
+        for item in self._items.values():
+            item.hide()
+
+    @property
+    def _frame_maps(self):
+        '''Return a dict of indexes into the frame store for the displayed
+dims ('dims'), the plotted elements ('elements'), and the elements of each
+line ('lines'). The indexes are recalculated only when self.elements,
+self.xyz, or self.lines change.'''
+        key = (
+            tuple(self.elements),
+            tuple(self.xyz),
+            tuple((n, tuple(d['elements'])) for n, d in self.lines.items())
+        )
+        if self._frame_maps_key != key:
+            elidx = {el: idx for idx, el in enumerate(self._frame_elements)}
+            self._frame_maps_cache = {
+                'dims': ['xyz'.index(d) for d in self.xyz[:2]],
+                'elements': np.array(
+                    [elidx[el] for el in self.elements if el in elidx],
+                    dtype=int
+                ),
+                'lines': {
+                    name: np.array(
+                        [elidx[el] for el in desc['elements'] if el in elidx],
+                        dtype=int
+                    ) for name, desc in self.lines.items()
+                }
+            }
+            self._frame_maps_key = key
+        return self._frame_maps_cache
+
     @property
     def _selected_range(self):
-        '''Return the range of the currently selected data.'''
-        xmin = self._sel_df.loc[:, self._element_cols['x']].min().min()
-        xmax = self._sel_df.loc[:, self._element_cols['x']].max().max()
-        ymin = self._sel_df.loc[:, self._element_cols['y']].min().min()
-        ymax = self._sel_df.loc[:, self._element_cols['y']].max().max()
+        '''Return the range of the currently selected data. The limits are NaN
+if no data are selected, e.g. when no elements are selected.'''
+        maps = self._frame_maps
+        sel = self._frames[self._sel_i0:self._sel_i0 + len(self._sel_sec)]
+        sel = sel[:, maps['elements'], :]
+        if sel.size == 0:
+            return ((np.nan, np.nan), (np.nan, np.nan))
+        xmin = np.nanmin(sel[:, :, maps['dims'][0]])
+        xmax = np.nanmax(sel[:, :, maps['dims'][0]])
+        ymin = np.nanmin(sel[:, :, maps['dims'][1]])
+        ymax = np.nanmax(sel[:, :, maps['dims'][1]])
         if self.landmarkdf is not None:
             xmin = np.min([xmin, self.landmarkdf.x.min()])
             xmax = np.max([xmax, self.landmarkdf.x.max()])
             ymin = np.min([ymin, self.landmarkdf.y.min()])
             ymax = np.max([ymax, self.landmarkdf.y.max()])
-        return ((xmin, xmax), (ymin, ymax))
+        return ((float(xmin), float(xmax)), (float(ymin), float(ymax)))
 
     def __init__(self, parent=None, **kwargs):
         super(ArticuWidget, self).__init__(parent)
         self.parent = parent
         self.plots = []
         self.df = None
+        self._sec = None  # df.sec as a sorted array, for time selections
+        self.derivs = None
+        self._frames = None   # Frame store of df coordinates
+        self._frame_elements = []  # Element names of frame store's second axis
         self.frameplot = self.addPlot(row=0, col=0)  # Plot of a single frame
         self.frameplot.setAspectLocked(True)
         self.traceplot = self.addPlot(row=0, col=1)  # Plot of time trace
@@ -61,37 +193,78 @@ x-ray microbeam.'''
         self.velplot = self.addPlot(row=1, col=1)    # Plot of element velocity over time
         self.pos_tcursor = pg.InfiniteLine(movable=True)
         self.vel_tcursor = pg.InfiniteLine(movable=True)
+        self.posplot.addItem(self.pos_tcursor)
+        self.velplot.addItem(self.vel_tcursor)
+        for plot in (self.frameplot, self.traceplot, self.posplot, self.velplot):
+            plot.showGrid(x=True, y=True, alpha=0.5)
+        # The position and velocity plots share their time axis, so a range
+        # change redraws the curves of both once, while a resize redraws only
+        # the curves of the plot that was resized.
+        self.velplot.setXLink(self.posplot)
+        self.posplot.getViewBox().sigXRangeChanged.connect(
+            lambda *args: self.update_posvel_plots()
+        )
+        for plot in (self.posplot, self.velplot):
+            plot.getViewBox().sigResized.connect(
+                lambda vb, plot=plot: self.update_posvel_plots(plots=[plot])
+            )
+        self._items = {}        # Persistent plot items, see _plot_item()
+        self._brush_cache = {}  # Brushes by color, see _brush()
+        self.animator = Animator(self._animate_frame, parent=self)
+        self.pen = pg.mkPen('g')
+        self.maxsymbsize = 5
         self.clear_plots()
 
     def clear_plots(self):
         self.landmarkdf = None
-        self.lines = []  # List of element dicts to link as a line.
+        self.lines = {}  # Dict of element dicts to link as a line.
         self.brushes = {}  # dict of symbolBrushes, one key per element
         self.elements = [] # List of elements to plot
 # TODO: don't hardcode xyz
         self.xyz = 'xyz'  # Mapping of displayed dims to data dims
         self._is_updating = False
+        self.overlay = None    # Overlaid repetitions, see plot_overlay()
+        self.clear_selection()
+
+    def clear_selection(self):
+        '''Forget the current time selection and hide its plots. The selection
+indexes into the frame store, so it must be cleared when the data change.'''
+        self.animator.stop()
 # TODO: rename _sel* attributes and think about appropriate place to update values
         self._sel_t1 = None
         self._sel_t2 = None
         self._sel_df = None
+        self._sel_sec = None
+        self._sel_i0 = None  # Index of the first selected row of df
+        self._sel_symbsizes = None
+        self._sel_alphas = None
+        self._trace_x = None   # Trace plot points, see _prepare_trace()
+        self._trace_shown = None
+        self._posvel = {}      # Position/velocity curves, see tplot()
         self._sel_landmarkdf = None
         self._selected_element_brushes = {}
-# TODO: hide tcursors
+        self._scatter_brushes_stale = True
+        self._frame_maps_key = None
+        self._frame_maps_cache = None
+        self._hide_plot_items()
         self.pos_tcursor.setPos(0.0)
         self.vel_tcursor.setPos(0.0)
+        self.pos_tcursor.hide()
+        self.vel_tcursor.hide()
 
 
     def init_dataplots(self, df, landmarkdf, lines, brushes, xyz):
+        self.clear_overlay()
+        self.clear_selection()
         self.df = df
+        self._sec = df.sec.values
+        self._frames, self._frame_elements = frame_store(df)
+        self.derivs = Derivatives(df)  # Velocities, calculated when plotted
         self.landmarkdf = landmarkdf
-        self.lines = lines or []  # List of element names to link as a line.
+        self.lines = lines or {}  # Dict of element names to link as a line.
         self.brushes = brushes or {}  # dict of symbolBrushes, one per element
         self.pen = pg.mkPen('g')
         self.xyz = xyz
-# TODO: update *._ as appropriate when object attributes change
-#        self._line_elements = [e for subl in self.lines for e in subl]
-        self._line_cols = {}
         self.pos_vel_dim = 'x'
         self.pos_vel_elements = []
         self.minsymbsize = 1   # Minimum symbol size
@@ -103,29 +276,94 @@ x-ray microbeam.'''
         '''Select a time range from dataframes and cache.'''
         self._sel_t1 = t1
         self._sel_t2 = t2
-        xmask = (self.df.sec >= t1) & (self.df.sec <= t2)
-        if not xmask.any():  # Zero length region is selected.
+        i0, i1 = tslice(self._sec, t1, t2)
+        if i1 <= i0:  # Zero length region is selected.
             # Select row nearest xend.
-            xmask[(self.df.sec - t2).abs().argmin()] = True
+            i0 = nearest_idx(self._sec, t2)
+            i1 = i0 + 1
             minsymbsize = self.maxsymbsize
             minalpha = self.maxalpha
         else:
             minsymbsize = self.minsymbsize
             minalpha = self.minalpha
-        symbsizes = np.linspace(minsymbsize, self.maxsymbsize, num=xmask.sum())
-        alphas = np.linspace(minalpha, self.maxalpha, num=xmask.sum())
-        mskdf = self.df.loc[xmask, :].copy()
+        symbsizes = np.linspace(minsymbsize, self.maxsymbsize, num=i1 - i0)
+        alphas = np.linspace(minalpha, self.maxalpha, num=i1 - i0)
+        mskdf = self.df.iloc[i0:i1].copy()
         mskdf = mskdf.assign(symbsizes=symbsizes)
         self._sel_df = mskdf
+        self._sel_sec = self._sec[i0:i1]
+        self._sel_i0 = i0
+        self._sel_symbsizes = symbsizes
+        self._sel_alphas = alphas
+
+    def _prepare_trace(self):
+        '''Precompute the coordinates, sizes and brushes of all points of the
+trace plot for the current selection, elements, dims and brushes. Points are
+stored in frame-major order, so the points of selected frames i0 to i1 are
+the slice [i0 * n_elements:i1 * n_elements].'''
+        maps = self._frame_maps
+        elidx = maps['elements']
+        xd, yd = maps['dims']
+        sel = self._frames[self._sel_i0:self._sel_i0 + len(self._sel_sec)]
+        sel = sel[:, elidx, :]
+        nel = len(elidx)
+        self._trace_x = np.ascontiguousarray(sel[:, :, xd]).ravel()
+        self._trace_y = np.ascontiguousarray(sel[:, :, yd]).ravel()
+        self._trace_sizes = np.repeat(self._sel_symbsizes, nel)
+        # Brushes are shared by all points with the same color and alpha.
+        alphas = np.clip(np.round(self._sel_alphas), 0, 255).astype(int)
+        uniq, inv = np.unique(alphas, return_inverse=True)
+        brushes = np.empty((len(alphas), nel), dtype=object)
+        els = [el for el in self.elements if el in self._frame_elements]
+        for eidx, el in enumerate(els):
+            table = np.empty(len(uniq), dtype=object)
+            for aidx, alpha in enumerate(uniq):
+                color = pg.mkColor(self.brushes.get(el, (128, 128, 128, 128)))
+                color.setAlpha(int(alpha))
+                table[aidx] = self._brush(color)
+            brushes[:, eidx] = table[inv]
+        self._trace_brushes = brushes.ravel()
+        self._trace_nel = nel
+        self._trace_shown = None   # Range of frames in the trace plot
+
+    def _update_trace(self, i0, i1):
+        '''Show the trace points of selected frames i0 to i1 in a single
+scatter plot. If the previous range started at i0 and ended at or before i1,
+only the points of the new frames are added.'''
+        if self._trace_x is None:
+            return
+        item = self._plot_item(
+            self.traceplot, 'trace_scatter', cls=pg.ScatterPlotItem, pen=None
+        )
+        shown = self._trace_shown
+        if shown is not None and shown[0] == i0 and shown[1] <= i1:
+            if shown[1] == i1:
+                return
+            start = shown[1]
+            method = item.addPoints
+        else:  # The range moved backwards or has a new start.
+            start = i0
+            method = item.setData
+        pts = slice(start * self._trace_nel, i1 * self._trace_nel)
+        x = self._trace_x[pts]
+        y = self._trace_y[pts]
+        ok = np.isfinite(x) & np.isfinite(y)
+        method(
+            x=x[ok],
+            y=y[ok],
+            size=self._trace_sizes[pts][ok],
+            brush=self._trace_brushes[pts][ok]
+        )
+        self._trace_shown = (i0, i1)
         
     def tplot(self, t1, t2):
         '''Create plots for time range.'''
+        self.overlay = None
         if t1 != self._sel_t1 and t2 != self._sel_t2:
             self.tselect(t1, t2)
-        self.frameplot.clear()
-        self.traceplot.clear()
-        self.posplot.clear()
-        self.velplot.clear()
+        # Plot items are reused; those that are not needed for the current
+        # elements, lines and landmarks stay hidden.
+        self._hide_plot_items()
         (xrng, yrng) = self._selected_range
         if not np.any(np.isnan([xrng, yrng])):
             self.frameplot.setRange(xRange=xrng, yRange=yrng)
@@ -133,47 +371,108 @@ x-ray microbeam.'''
         elemdims = [
             '{}_{}'.format(el, self.pos_vel_dim) for el in self.pos_vel_elements
         ]
+        sel = slice(self._sel_i0, self._sel_i0 + len(self._sel_sec))
+        # The min/max envelopes used to draw the position and velocity curves
+        # are calculated once per selection; see update_posvel_plots().
+        self._posvel = {}
         for ed, el in zip(elemdims, self.pos_vel_elements):
-            try:
-                symbr = pg.mkBrush(color=self.brushes[el])
-            except KeyError:
-                symbr = pg.mkBrush(color=(128, 128, 128, 128))
-            self.posplot.plot(
-                self._sel_df.sec.values,
-                self._sel_df.loc[:, [ed]].values.squeeze(),
-                symbol='o',
-                pen=None,
-                symbolBrush=symbr,
-                symbolSize=self.maxsymbsize
-            )
-            self.posplot.showGrid(x=True, y=True, alpha=0.5)
-            self.posplot.addItem(self.pos_tcursor)
-            self.velplot.plot(
-                self._sel_df.sec.values,
-                self._sel_df.loc[:, [ed + '_vel']].values.squeeze(),
-                symbol='o',
-                pen=None,
-                symbolBrush=symbr,
-                symbolSize=self.maxsymbsize
+            symbr = self._element_brush(el)
+            for plot, name, y in (
+                    (self.posplot, 'pos', self._sel_df.loc[:, [ed]].values.squeeze()),
+                    (self.velplot, 'vel', self.derivs.velocity(ed)[sel])
+                ):
+                item = self._plot_item(plot, (name, el))
+                item.show()
+                self._posvel[(name, el)] = {
+                    'item': item,
+                    'plot': plot,
+                    'envelope': EnvelopePyramid(
+                        np.atleast_1d(np.asarray(y, dtype=float)), ignore_nan=True
+                    ),
+                    'brush': symbr,
+                    'mode': None
+                }
+        for plot in (self.posplot, self.velplot):
+            plot.enableAutoRange(x=False)
+        # A range change redraws the curves through sigXRangeChanged, so they
+        # are drawn here only if the range is unchanged.
+        oldrange = self.posplot.getViewBox().viewRange()[0]
+        self.posplot.setXRange(self._sel_sec[0], self._sel_sec[-1], padding=0)
+        if self.posplot.getViewBox().viewRange()[0] == oldrange:
+            self.update_posvel_plots()
+        self.pos_tcursor.setVisible(len(elemdims) > 0)
+        self.vel_tcursor.setVisible(len(elemdims) > 0)
+        self._plot_landmarks()
+        for name, desc in self.lines.items():
+            item = self._plot_item(
+                self.frameplot, ('line', name), pen=desc['pen']
             )
-            self.velplot.showGrid(x=True, y=True, alpha=0.5)
-            self.velplot.addItem(self.vel_tcursor)
-        if self.landmarkdf is not None:
-            for g in self.landmarkdf.groupby('landmark'):
-                wfr = self.frameplot.plot(
-                    g[1].x.values, g[1].y.values, pen=self.pen
-                )
-                wfr.setObjectName('_landmark_{}'.format(g[1].landmark))
-                wtr = self.traceplot.plot(
-                    g[1].x.values, g[1].y.values, pen=self.pen
-                )
-                wfr.setObjectName('_landmark_{}'.format(g[1].landmark))
+            item.setPen(desc['pen'])
+            item.show()
+        item = self._items.get('frameplot_scatter')
+        if item is not None:
+            item.show()
+        # The elements, and so the number of scatter points, may have changed,
+        # so the brushes are rebuilt and set along with the data in the next
+        # update_tplot().
+        self._selected_element_brushes = {}
+        self._scatter_brushes_stale = True
+        self._prepare_trace()
+        item = self._items.get('trace_scatter')
+        if item is not None:
+            item.show()
         self.update_tplot(t1, t1)   # Set to start of frame
 
+    def _plot_landmarks(self):
+        '''Show landmarks in the frame and trace plots.'''
+        if self.landmarkdf is None:
+            return
+        for name, g in self.landmarkdf.groupby('landmark', observed=True):
+            for pname, plot in (
+                    ('frame', self.frameplot), ('trace', self.traceplot)
+                ):
+                item = self._plot_item(
+                    plot, (pname, 'landmark', name), pen=self.pen
+                )
+                item.setData(g.x.values, g.y.values)
+                item.show()
+
+    def update_posvel_plots(self, plots=None):
+        '''Draw the position and velocity curves in the current view ranges,
+or only the curves in plots if it is not None. When the view holds more
+samples than there is room for symbols, each curve is drawn as a line from its
+min/max envelope at the level that matches the width of the view in pixels.
+When zoomed in, samples are drawn as symbols.'''
+        for curve in self._posvel.values():
+            if plots is not None and curve['plot'] not in plots:
+                continue
+            (p0, p1), (x0, x1), npixels = padded_view(curve['plot'].getViewBox())
+            i0 = np.searchsorted(self._sel_sec, p0, side='left')
+            i1 = np.searchsorted(self._sel_sec, p1, side='right')
+            nvisible = np.searchsorted(self._sel_sec, x1, side='right') - \
+                np.searchsorted(self._sel_sec, x0, side='left')
+            item = curve['item']
+            if nvisible <= npixels / self.maxsymbsize:
+                if curve['mode'] != 'symbols':
+                    item.setPen(None)
+                    item.setSymbol('o')
+                    item.setSymbolBrush(curve['brush'])
+                    item.setSymbolSize(self.maxsymbsize)
+                    curve['mode'] = 'symbols'
+                idx = np.arange(i0, i1)
+                vals = curve['envelope'].data[i0:i1]
+            else:
+                if curve['mode'] != 'lines':
+                    item.setSymbol(None)
+                    item.setPen(pg.mkPen(color=curve['brush'].color()))
+                    curve['mode'] = 'lines'
+                idx, vals = curve['envelope'].segment(i0, i1, 3 * npixels)
+            item.setData(x=self._sel_sec[idx], y=vals)
+
     def update_tplot(self, t1=None, t2=None):
         '''Update existing tplot between t1 and t2. Return True on success,
 False if no update occurs.'''
-        if self.df is None:
+        if self.df is None or self._sel_sec is None:
             return False
         # Skip current update if another update is still executing in order to
         # avoid RecursionError when too many calls to update_tplot() are made.
@@ -190,100 +489,193 @@ False if no update occurs.'''
 #        print('update_tplot {:0.4f} {:0.4f}'.format(t1, t2))
         self.pos_tcursor.setValue(t2)
         self.vel_tcursor.setValue(t2)
-        xmask = (self._sel_df.sec >= t1) & (self._sel_df.sec <= t2)
-# TODO: is choosing first row right solution for all-false xmask?
-        if not xmask.any():
-            xmask.iloc[0] = True
-        mskdf = self._sel_df.loc[xmask, :]
-        endidx = xmask[::-1].argmax()  # index of last selected value
-        # Plot element lines.
+        i0, i1 = tslice(self._sel_sec, t1, t2)
+# TODO: is choosing first row right solution for an empty slice?
+        if i1 <= i0:
+            i0, i1 = 0, 1
+        maps = self._frame_maps
+        xd, yd = maps['dims']
+        # Absolute index into the frame store of the last frame.
+        endidx = self._sel_i0 + i1 - 1
+        endframe = self._frames[endidx]
+        # Plot element lines at end of time selection.
         for name, desc in self.lines.items():
-# TODO: not right place to set _line_cols
-            self._line_cols[name] = {
-                'x': ['{}_{}'.format(el, self.xyz[0]) for el in desc['elements']],
-                'y': ['{}_{}'.format(el, self.xyz[1]) for el in desc['elements']]
+            lidx = maps['lines'][name]
+            self._plot_item(
+                self.frameplot, ('line', name), pen=desc['pen']
+            ).setData(endframe[lidx, xd], endframe[lidx, yd])
+        # Scatter plot of elements at end of selection.
+        elidx = maps['elements']
+        opts = {}
+        if self._scatter_brushes_stale is True:
+            opts['symbolBrush'] = self.selected_element_brushes
+            self._scatter_brushes_stale = False
+        self._plot_item(
+            self.frameplot,
+            'frameplot_scatter',
+            symbol='o',
+            pen=None,
+            symbolSize=self.maxsymbsize
+        ).setData(endframe[elidx, xd], endframe[elidx, yd], **opts)
+        self._update_trace(i0, i1)
+        self._is_updating = False
+        return True
+
+    def plot_overlay(self, stack, elements, reps=None):
+        '''Overlay time-normalized repetitions in the frame and trace plots.
+stack is an array of shape (n_reps, n_frames, n_elements, 3) with dims in
+'xyz' order, like the one returned by EmaEcogDataLoader.get_rep_stack(), and
+elements are the names of its third axis. The trace plot shows the trajectory
+of each element in every rep, and its mean trajectory with +/- 1 SD error
+bars. The frame plot shows one normalized frame; see update_overlay().'''
+        self._hide_plot_items()
+        self.pos_tcursor.hide()
+        self.vel_tcursor.hide()
+        xd, yd = ['xyz'.index(d) for d in self.xyz[:2]]
+        with warnings.catch_warnings():  # All-NaN frames are expected.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean = np.nanmean(stack, axis=0)
+            sd = np.nanstd(stack, axis=0)
+        nreps = stack.shape[0]
+        # Rep and mean brushes of each element, and of each point of the
+        # frame scatter plots.
+        repbrushes = []
+        meanbrushes = []
+        for el in elements:
+            color = pg.mkColor(self.brushes.get(el, (128, 128, 128, 255)))
+            meanbrushes.append(self._brush(color))
+            color.setAlpha(64)
+            repbrushes.append(self._brush(color))
+        self.overlay = {
+            'stack': stack,
+            'elements': elements,
+            'reps': reps,
+            'mean': mean,
+            'sd': sd,
+            'dims': (xd, yd),
+            'repbrushes': np.array(repbrushes * nreps, dtype=object),
+            'meanbrushes': np.array(meanbrushes, dtype=object),
+            'lines': {
+                name: np.array(
+                    [elements.index(el) for el in desc['elements']
+                        if el in elements],
+                    dtype=int
+                ) for name, desc in self.lines.items()
             }
-            try:
-                di = self.frameplot.findChild(pg.PlotDataItem, '_line_' + name)
-                assert(di is not None)
-                di.setData(
-                    mskdf.loc[endidx, self._line_cols[name]['x']].values,
-                    mskdf.loc[endidx, self._line_cols[name]['y']].values
-                )
-            except AssertionError:
-                # Plot line at end of time selection.
-                line = self.frameplot.plot(
-                    mskdf.loc[endidx, self._line_cols[name]['x']].values,
-                    mskdf.loc[endidx, self._line_cols[name]['y']].values,
-                    pen=desc['pen']
-                )
-                line.setParent(self.frameplot)
-                line.setObjectName('_line_{}'.format(name))
-                self.frameplot.showGrid(x=True, y=True, alpha=0.5)
-                self.frameplot.setAspectLocked(True)
-        # Scatter plot of elements.
-        try:
-            di = self.frameplot.findChild(
-                pg.PlotDataItem,
-                '_frameplot_scatter_'
+        }
+        # Draw the reps of an element as one line, with the reps separated by
+        # NaN so that they are not connected.
+        sep = np.full((nreps, 1), np.nan, dtype=stack.dtype)
+        for eidx, el in enumerate(elements):
+            repcolor = repbrushes[eidx].color()
+            meancolor = meanbrushes[eidx].color()
+            item = self._plot_item(self.traceplot, ('overlay', 'reps', el))
+            item.setPen(pg.mkPen(color=repcolor))
+            item.setData(
+                np.hstack([stack[:, :, eidx, xd], sep]).ravel(),
+                np.hstack([stack[:, :, eidx, yd], sep]).ravel(),
+                connect='finite'
             )
-            assert(di is not None)
-            di.setData(
-                mskdf.loc[endidx, self._element_cols['x']].values,
-                mskdf.loc[endidx, self._element_cols['y']].values
+            item.show()
+            item = self._plot_item(self.traceplot, ('overlay', 'mean', el))
+            item.setPen(pg.mkPen(color=meancolor, width=2))
+            item.setData(mean[:, eidx, xd], mean[:, eidx, yd], connect='finite')
+            item.show()
+            item = self._plot_item(
+                self.traceplot, ('overlay', 'sd', el), cls=pg.ErrorBarItem
             )
-        except AssertionError:
-            # Plot non-tongue elements at end of selection.
-            frsc = self.frameplot.plot(
-                mskdf.loc[endidx, self._element_cols['x']].values,
-                mskdf.loc[endidx, self._element_cols['y']].values,
-                symbol='o',
-                pen=None,
-                symbolBrush=self.selected_element_brushes,
-                symbolSize=self.maxsymbsize
+            ok = np.isfinite(mean[:, eidx, [xd, yd]]).all(axis=1) & \
+                np.isfinite(sd[:, eidx, [xd, yd]]).all(axis=1)
+            item.setData(
+                x=mean[ok, eidx, xd],
+                y=mean[ok, eidx, yd],
+                width=2 * sd[ok, eidx, xd],
+                height=2 * sd[ok, eidx, yd],
+                pen=pg.mkPen(color=meancolor)
             )
-            frsc.setParent(self.frameplot)
-            frsc.setObjectName('_frameplot_scatter_')
-        for idx, pts in enumerate(
-                zip(self._element_cols['x'], self._element_cols['y'])
-            ):
-            elx, ely = pts
-            try:
-                # elx[:-2] is element name without suffix '_x', '_y', or '_z'.
-                symbr = pg.mkBrush(color=self.brushes[elx[:-2]])
-            except KeyError:
-                symbr = pg.mkBrush(color=(128, 128, 128, 128))
-            try:
-                di = self.traceplot.findChild(pg.PlotDataItem, '_element_'+elx)
-                assert(di is not None)
-                di.setData(
-                    mskdf.loc[:endidx, elx].values,
-                    mskdf.loc[:endidx, ely].values
-                )
-            except AssertionError:
-                trp = self.traceplot.plot(
-                    mskdf.loc[:endidx, elx].values,
-                    mskdf.loc[:endidx, ely].values,
-                    symbolSize=mskdf.loc[:endidx, 'symbsizes'],
-                    pen=None,
-                    symbol='o',
-                    symbolBrush=symbr
-                )
-                trp.setParent(self.traceplot)
-                trp.setObjectName('_element_{}'.format(elx))
-                self.traceplot.showGrid(x=True, y=True, alpha=0.5)
-                self.traceplot.setAspectLocked(True)
-        pg.QtGui.QApplication.processEvents()
-        self._is_updating = False
-        return True
+            item.show()
+        self._plot_landmarks()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            xrng = [float(np.nanmin(stack[..., xd])), float(np.nanmax(stack[..., xd]))]
+            yrng = [float(np.nanmin(stack[..., yd])), float(np.nanmax(stack[..., yd]))]
+        if self.landmarkdf is not None:
+            xrng = [
+                min(xrng[0], self.landmarkdf.x.min()),
+                max(xrng[1], self.landmarkdf.x.max())
+            ]
+            yrng = [
+                min(yrng[0], self.landmarkdf.y.min()),
+                max(yrng[1], self.landmarkdf.y.max())
+            ]
+        if not np.any(np.isnan([xrng, yrng])):
+            self.frameplot.setRange(xRange=xrng, yRange=yrng)
+            self.traceplot.setRange(xRange=xrng, yRange=yrng)
+        self.update_overlay(1.0)
+
+    def update_overlay(self, u):
+        '''Show the overlaid reps in the frame plot at normalized time u, from
+0.0 (start) to 1.0 (end).'''
+        if self.overlay is None:
+            return
+        ov = self.overlay
+        xd, yd = ov['dims']
+        nframes = ov['stack'].shape[1]
+        k = int(np.clip(np.round(u * (nframes - 1)), 0, nframes - 1))
+        frame = ov['stack'][:, k]    # (n_reps, n_elements, dims)
+        mean = ov['mean'][k]
+        sd = ov['sd'][k]
+        x = frame[:, :, xd].ravel()
+        y = frame[:, :, yd].ravel()
+        ok = np.isfinite(x) & np.isfinite(y)
+        item = self._plot_item(
+            self.frameplot, ('overlay', 'reps'), cls=pg.ScatterPlotItem, pen=None
+        )
+        item.setData(
+            x=x[ok], y=y[ok], size=self.maxsymbsize, brush=ov['repbrushes'][ok]
+        )
+        item.show()
+        for name, lidx in ov['lines'].items():
+            item = self._plot_item(
+                self.frameplot, ('overlay', 'line', name),
+                pen=self.lines[name]['pen']
+            )
+            item.setData(mean[lidx, xd], mean[lidx, yd])
+            item.show()
+        ok = np.isfinite(mean[:, [xd, yd]]).all(axis=1) & \
+            np.isfinite(sd[:, [xd, yd]]).all(axis=1)
+        item = self._plot_item(
+            self.frameplot, ('overlay', 'mean'), cls=pg.ScatterPlotItem, pen=None
+        )
+        item.setData(
+            x=mean[ok, xd], y=mean[ok, yd], size=2 * self.maxsymbsize,
+            brush=ov['meanbrushes'][ok]
+        )
+        item.show()
+        item = self._plot_item(
+            self.frameplot, ('overlay', 'sd'), cls=pg.ErrorBarItem
+        )
+        item.setData(
+            x=mean[ok, xd], y=mean[ok, yd],
+            width=2 * sd[ok, xd], height=2 * sd[ok, yd]
+        )
+        item.show()
+
+    def clear_overlay(self):
+        '''Hide the overlaid reps.'''
+        for key, item in self._items.items():
+            if isinstance(key, tuple) and key[0] == 'overlay':
+                item.hide()
+        self.overlay = None
 
     def animate(self):
-        '''Animate tplots based on currently selected times.'''
+        '''Animate tplots based on currently selected times. The animation runs
+in the background; use self.animator to pause, resume, seek, or change the
+playback rate.'''
         if self._sel_t1 is None or self._sel_t2 is None:
             return
-        tstep = 0.020
-        nsteps = np.ceil((self._sel_t2 - self._sel_t1) / tstep) + 2
-        tsel = np.linspace(self._sel_t1, self._sel_t2, nsteps)
-        for t in tsel:
-            self.update_tplot(self._sel_t1, t)
+        self.animator.start(self._sel_t1, self._sel_t2)
 
+    def _animate_frame(self, t):
+        '''Update tplots for an animation frame at time t.'''
+        self.update_tplot(self._sel_t1, t)
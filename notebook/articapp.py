@@ -3,7 +3,7 @@ import pyqtgraph as pg
 import pyqtgraph.dockarea as dock
 
 from channel import ChannelWidget
-from artic import ArticuWidget
+from artic import ArticuWidget, EMA_LINES, EMA_BRUSHES
 
 class ArticApp(QtGui.QMainWindow):
     def __init__(self, data_loader=None, parent=None, **kwargs):
@@ -27,12 +27,24 @@ class ArticApp(QtGui.QMainWindow):
         self.playsel = QtGui.QPushButton('Play sel')
         self.updatesel = QtGui.QPushButton('Update sel')
         self.anim = QtGui.QPushButton('Animate')
+        self.animpause = QtGui.QPushButton('Pause')
+        self.animrate = QtGui.QDoubleSpinBox()
+        self.animrate.setRange(0.05, 4.0)
+        self.animrate.setSingleStep(0.25)
+        self.animrate.setValue(1.0)
+        self.animrate.setSuffix('x')
+        self.animfps = QtGui.QLabel('fps: -')
+        self.overlaybtn = QtGui.QPushButton('Overlay reps')
         self.ctrldock.addWidget(self.playall, row=0)
         self.ctrldock.addWidget(self.playsel, row=1)
         self.ctrldock.addWidget(self.updatesel, row=2)
         self.ctrldock.addWidget(self.anim, row=3)
+        self.ctrldock.addWidget(self.animpause, row=4)
+        self.ctrldock.addWidget(self.animrate, row=5)
+        self.ctrldock.addWidget(self.animfps, row=6)
+        self.ctrldock.addWidget(self.overlaybtn, row=7)
         if self.data_loader is not None:
-            self.ctrldock.addWidget(self.data_loader, row=4)
+            self.ctrldock.addWidget(self.data_loader, row=8)
     
         # Make widgets for audio channel and articulation data. Hook them together so that
         # when the xrange changes on the audio channels the articulation windows update.
@@ -48,8 +60,14 @@ class ArticApp(QtGui.QMainWindow):
         self.playall.clicked.connect(self.cw.play_all)
         self.playsel.clicked.connect(self.cw.play_viewbox)
         self.updatesel.clicked.connect(self.app_make_tplot)
-# TODO: prevent crash if element is selected while animate() is running
+        self.overlaybtn.clicked.connect(self.app_make_overlay)
+        # Animate the articulation plots in step with audio playback.
+        self.cw.cwsig_playback_started.connect(self.sync_artic_playback)
         self.anim.clicked.connect(self.aw.animate)
+        self.animpause.clicked.connect(self.aw.animator.toggle_pause)
+        self.animrate.valueChanged.connect(self.aw.animator.set_rate)
+        self.aw.animator.sigFps.connect(self.update_animfps)
+        self.aw.animator.sigStateChanged.connect(self.update_animpause)
 
         # Update audio_tcursor when pos_tcursor or vel_tcusor is dragged
         # or when pos_tcursor is changed via animate. (No need to also update
@@ -64,6 +82,7 @@ class ArticApp(QtGui.QMainWindow):
 
         if self.data_loader is not None:
             self.data_loader.data_loaded.connect(self.init_plots)
+            self.data_loader.rep_stack_loaded.connect(self.plot_rep_stack)
             self.data_loader.xyz_map_changed.connect(self.handle_xyz_map_change)
             self.data_loader.selected_elements_changed.connect(
                 self.handle_element_select
@@ -88,6 +107,8 @@ class ArticApp(QtGui.QMainWindow):
 
     def app_make_tplot(self, e):
         '''Handle a zoom event in the audio and pass it to the articulation.'''
+        # The plots are about to be rebuilt, so stop any running animation.
+        self.aw.animator.stop()
         tstart, tend = self.cw.audioplot.getViewBox().viewRange()[0]
         self.aw.elements = self.data_loader.selected_elements
         self.aw.brushes = self.data_loader.selected_element_colors
@@ -96,39 +117,62 @@ class ArticApp(QtGui.QMainWindow):
         self.aw.xyz = self.data_loader.xyz_map
         self.aw.tplot(tstart, tend)
 
+    def app_make_overlay(self, e):
+        '''Start loading all repetitions of the selected utterance in the
+background, to be overlaid, time-normalized, in the articulation plots by
+plot_rep_stack() when they are loaded.'''
+        dl = self.data_loader
+        if dl is None:
+            return
+        self.aw.animator.stop()
+        dl.load_rep_stack(elements=dl.selected_elements or None)
+
+    def plot_rep_stack(self, stack, elements, reps):
+        '''Overlay time-normalized repetitions in the articulation plots.'''
+        self.aw.animator.stop()
+        self.aw.brushes = self.data_loader.selected_element_colors
+        self.aw.xyz = self.data_loader.xyz_map
+        self.aw.plot_overlay(stack, elements, reps)
+
+    def sync_artic_playback(self, t0, t1):
+        '''Animate the articulation plots from t0 to t1, using the audio
+playback position as the animation clock.'''
+        if self.aw.df is None:
+            return
+        self.aw.animator.start(t0, t1, clock=self.cw.playback_position)
+
     def update_audio_tcursor(self, e):
         x = e.pos()[0]
         self.cw.tcursor.setValue(x)
 
     def update_artic_plots(self, e):
         x = e.pos()[0]
+        if self.aw.overlay is not None:
+            # Map the cursor in the audio view to normalized time.
+            t0, t1 = self.cw.audioplot.getViewBox().viewRange()[0]
+            self.aw.update_overlay((x - t0) / (t1 - t0))
+            return
+        if self.aw.animator.state != 'stopped':
+            self.aw.animator.seek(x)
         self.aw.update_tplot(t2=x)
 
+    def update_animfps(self, fps):
+        self.animfps.setText('fps: {:0.1f}'.format(fps))
+
+    def update_animpause(self, state):
+        self.animpause.setText('Resume' if state == 'paused' else 'Pause')
+
     def init_plots(self):
+        # The new data replace the data that are being animated or played.
+        self.aw.animator.stop()
+        self.cw.stop_playback()
         dl = self.data_loader
-        self.cw.init_audioplot_data(dl.au, dl.rate)
+        self.cw.init_audioplot_data(dl.au, dl.rate, envelope=dl.envelope)
         self.aw.init_dataplots(
             dl.datadf,
             dl.landmarkdf,
             xyz=dl.xyz_map,
-# TODO: don't hardcode values shown below
-            lines={
-                'tongue': {
-                    'elements': ['TT', 'TB', 'TD'],
-                    'pen': (128, 255, 128, 128)
-                },
-                'mouth': {
-                    'elements': ['LL', 'UL'],
-                    'pen': (128, 128, 255, 128)
-                }
-            },
-            brushes={   # symbolBrushes used for element scatter plots
-                'TD': 'r',
-                'TB': 'r',
-                'TT': 'r',
-                'LL': 'y',
-                'UL': 'y',
-                'JW': 'k',
-                'UI': 'k',
-            },
+# TODO: don't hardcode values in EMA_LINES and EMA_BRUSHES
+            lines=EMA_LINES,
+            brushes=EMA_BRUSHES,   # symbolBrushes used for element scatter plots
         )
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+
+# Prebuild the binary .ndi cache for an EMA-ECOG data directory.
+# Usage: build_cache.py datadir [cachedir]
+
+import sys
+from ema import EmaEcogDataLoader
+
+datadir = sys.argv[1]
+cachedir = sys.argv[2] if len(sys.argv) > 2 else None
+
+loader = EmaEcogDataLoader(datadir, cachedir=cachedir)
+nparsed = loader.build_cache(verbose=True)
+print('{} files cached in {}'.format(nparsed, loader.cache.cachedir))
@@ -2,11 +2,14 @@ from pyqtgraph.Qt import QtCore
 import pyqtgraph as pg
 import numpy as np
 import simpleaudio as sa
+from envelope import EnvelopePyramid, padded_view
 
 # TODO: right name for the classes?
 class ChannelWidget(pg.GraphicsLayoutWidget):
 # TODO: signal should be a single range instead of two floats
     cwsig_x_zoomed = QtCore.pyqtSignal(object)
+    # Emitted with start and end times (in seconds) when playback starts.
+    cwsig_playback_started = QtCore.pyqtSignal(float, float)
     
     def __init__(self, parent=None, **kwargs):
         super(ChannelWidget, self).__init__(parent)
@@ -19,11 +22,22 @@ class ChannelWidget(pg.GraphicsLayoutWidget):
         self.tcursor = pg.InfiniteLine(movable=True)
         self.selectors = [None, None]
         self.quickzoom_halfwin = 0.100
+        # Output latency of the audio device, in seconds. Subtracted from the
+        # elapsed playback time in playback_position().
+        self.playback_latency = 0.0
+        self._play_obj = None
+        self._play_t0 = None
+        self._play_t1 = None
+        self._play_clock = QtCore.QElapsedTimer()
 
         # To be set in init_audioplot_data.
         self.data = None
         self.rate = None
-        self.sec = None
+        self.envelope = None
+        self.curve = None
+        self.audioplot.getViewBox().sigXRangeChanged.connect(
+            self.update_audioplot_curve
+        )
 #        self.stream = None
 
 #    def _open_stream_(self):
@@ -38,24 +52,43 @@ class ChannelWidget(pg.GraphicsLayoutWidget):
 #        )
 #        return stream
 
-    def init_audioplot_data(self, data, rate):
-        '''Clear existing plots and load new audio.'''
+    def init_audioplot_data(self, data, rate, cachefile=None, srcfile=None,
+                            envelope=None):
+        '''Clear existing plots and load new audio. The waveform is drawn from
+a min/max envelope pyramid. Pass envelope if it was built elsewhere, e.g. in a
+worker thread, since building it reads all of data. Otherwise it is read from
+cachefile if it is given and valid, or else calculated and saved to cachefile.
+srcfile is the audio file that data were read from, if any; the cached pyramid
+is not valid if srcfile has changed since it was saved.'''
         self.data = data
         self.rate = rate
-        self.sec = np.arange(len(data)) / rate
-        self.audioplot.plot(
-            x=self.sec,
-            y=data,
-            pen=self.pen,
-            clear=True
-        )
-        self.audioplot.setDownsampling(auto=True)
+        self.envelope = envelope
+        if self.envelope is None and cachefile is not None:
+            self.envelope = EnvelopePyramid.load(cachefile, data, srcfile=srcfile)
+        if self.envelope is None:
+            self.envelope = EnvelopePyramid(data)
+            if cachefile is not None:
+                self.envelope.save(cachefile, srcfile=srcfile)
+        self.curve = self.audioplot.plot(pen=self.pen, clear=True)
         self.audioplot.addItem(self.tcursor)
+        self.audioplot.getViewBox().setXRange(0.0, len(data) / rate, padding=0)
+        self.update_audioplot_curve()
         self.audioplot.getViewBox().autoRange()
         #if self.stream is None:
         #    self.stream = self._open_stream_()
 # TODO: emit signal when data changes (or determine which signal is already emitted)
 
+    def update_audioplot_curve(self, *args):
+        '''Draw the waveform in the current view range at the envelope level
+that matches the width of the view in pixels.'''
+        if self.curve is None:
+            return
+        (p0, p1), _, npixels = padded_view(self.audioplot.getViewBox())
+        idx, vals = self.envelope.segment(
+            np.floor(p0 * self.rate), np.ceil(p1 * self.rate) + 1, 3 * npixels
+        )
+        self.curve.setData(x=idx / self.rate, y=vals)
+
     def zoom_to_selectors(self):
         '''Zoom viewbox to bounds selected by selectors.'''
         try:
@@ -78,20 +111,42 @@ class ChannelWidget(pg.GraphicsLayoutWidget):
         self.play_samples(0, len(self.data) - 1)
 
     def play_samples(self, s0, s1):
-        '''Play audio from sample s0 to sample s1.'''
-        play_obj = sa.play_buffer(
+        '''Start playing audio from sample s0 to sample s1 and return without
+waiting for playback to finish. Any current playback is stopped first.'''
+        self.stop_playback()
+        s0 = max(s0, 0)
+        self._play_obj = sa.play_buffer(
             self.data[s0:s1].astype(np.int16),
             1,   # Number of channels
             2,   # Bytes per sample
             self.rate  # Samplerate
         )
-        play_obj.wait_done()
+        self._play_clock.start()
+        self._play_t0 = s0 / self.rate
+        self._play_t1 = s1 / self.rate
+        self.cwsig_playback_started.emit(self._play_t0, self._play_t1)
 # TODO: support other dtype besides int16
 #        print('playing', s0, s1)
 #        self.stream.write(
 #            self.data[s0:s1].astype(np.int16).tostring()
 #        )
 
+    def stop_playback(self):
+        '''Stop current playback, if any.'''
+        if self._play_obj is not None:
+            self._play_obj.stop()
+            self._play_obj = None
+
+    def playback_position(self):
+        '''Return the time (in seconds) of the audio currently being played,
+or None if playback has finished. Each call measures the time elapsed since
+playback started, so the position doesn't drift as error accumulates over
+long selections.'''
+        if self._play_obj is None or not self._play_obj.is_playing():
+            return None
+        elapsed = self._play_clock.elapsed() * 1e-3 - self.playback_latency
+        return min(self._play_t0 + max(elapsed, 0.0), self._play_t1)
+
     def mousePressEvent(self, e):
         self._pressed_screenpos = e.screenPos()
         super(ChannelWidget, self).mousePressEvent(e)
@@ -0,0 +1,334 @@
+import os, sys, hashlib, threading, collections, zipfile, tempfile, shutil
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import envelope   # Not from-imported, since envelope imports this module.
+
+def user_cachedir(datadir):
+    '''Return the default cache directory for datadir, which is in the user's
+cache directory ($XDG_CACHE_HOME, ~/Library/Caches or %LOCALAPPDATA%) rather
+than in datadir, so that data directories are never written to unless a
+cache in datadir is requested.'''
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    elif sys.platform == 'darwin':
+        base = os.path.expanduser('~/Library/Caches')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    datadir = os.path.abspath(datadir)
+    h = hashlib.sha1(datadir.encode('utf-8')).hexdigest()[:16]
+    return os.path.join(
+        base, 'articuvis', '{}-{}'.format(os.path.basename(datadir), h)
+    )
+
+def default_cachedir(datadir, cache_in_datadir=False):
+    '''Return the cache directory to use for datadir when none is given: a
+'.articuvis_cache' directory in datadir if cache_in_datadir is True, otherwise
+user_cachedir(datadir).'''
+    if cache_in_datadir is True:
+        return os.path.join(datadir, '.articuvis_cache')
+    return user_cachedir(datadir)
+
+def atomic_write(fname, write, mode='wb'):
+    '''Write fname by calling write(fh) with a temporary file in the same
+directory opened with mode, then renaming the temporary file to fname, so that
+readers never see a partial file. The directory is created if necessary.
+Return True on success, False if fname could not be written (e.g. it is on a
+read-only filesystem). Exceptions other than OSError raised by write are
+passed on.'''
+    tmpname = '{}.{}.{}.tmp'.format(fname, os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+        with open(tmpname, mode) as fh:
+            write(fh)
+        os.replace(tmpname, fname)
+    except BaseException as e:
+        try:
+            os.remove(tmpname)
+        except OSError:
+            pass
+        if isinstance(e, OSError):
+            return False
+        raise
+    return True
+
+class ColumnarCache():
+    '''An on-disk binary cache of DataFrames parsed from text data files.
+
+Each cached DataFrame is stored as one .npz file with one array per column.
+Entries are keyed on the absolute path of the source file plus an optional
+key (e.g. the parse parameters), and are invalidated when the modification
+time or size of the source file changes.'''
+    def __init__(self, cachedir, *args, **kwargs):
+        super(ColumnarCache, self).__init__(*args, **kwargs)
+        self.cachedir = cachedir
+
+    def cache_fname(self, srcfile, key=None):
+        '''Return the name of the cache file for srcfile and key.'''
+        h = hashlib.sha1(
+            repr((os.path.abspath(srcfile), key)).encode('utf-8')
+        ).hexdigest()
+        return os.path.join(self.cachedir, '{}.npz'.format(h))
+
+    def _src_stamp(self, srcfile):
+        '''Return the modification time and size of srcfile.'''
+        st = os.stat(srcfile)
+        return np.array([st.st_mtime_ns, st.st_size], dtype=np.int64)
+
+    def is_valid(self, srcfile, key=None):
+        '''Return True if there is a valid cache entry for srcfile and key.
+Only the entry's stamp is read.'''
+        try:
+            with np.load(self.cache_fname(srcfile, key)) as npz:
+                return np.array_equal(npz['_stamp'], self._src_stamp(srcfile))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return False
+
+    def load(self, srcfile, key=None):
+        '''Return the cached DataFrame for srcfile and key, or None if there
+is no valid cache entry.'''
+        try:
+            with np.load(self.cache_fname(srcfile, key)) as npz:
+                if not np.array_equal(npz['_stamp'], self._src_stamp(srcfile)):
+                    return None
+                cols = [str(c) for c in npz['_columns']]
+                return pd.DataFrame(
+                    {c: npz['c{}'.format(idx)] for idx, c in enumerate(cols)},
+                    columns=cols
+                )
+        # Missing or corrupt entry.
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+
+    def save(self, srcfile, df, key=None):
+        '''Save df as the cache entry for srcfile and key with atomic_write().
+Return True on success, False if the cache could not be written.'''
+        arrays = {
+            'c{}'.format(idx): df[c].values for idx, c in enumerate(df.columns)
+        }
+        arrays['_columns'] = np.array(df.columns, dtype=str)
+        try:
+            arrays['_stamp'] = self._src_stamp(srcfile)
+        except OSError:
+            return False
+        return atomic_write(
+            self.cache_fname(srcfile, key), lambda fh: np.savez(fh, **arrays)
+        )
+
+    def save_chunks(self, srcfile, chunks, key=None):
+        '''Save the DataFrames in the iterable chunks, which must all have the
+same columns, as the cache entry for srcfile and key. Only one chunk is held
+in memory at a time. Return True on success, False if the cache could not be
+written.'''
+        try:
+            os.makedirs(self.cachedir, exist_ok=True)
+            tmpdir = tempfile.mkdtemp(dir=self.cachedir)
+        except OSError:
+            return False
+        try:
+            # Write each column of each chunk to its own .npy file, then copy
+            # them into the .npz once the total length and dtype are known.
+            columns = None
+            nchunks = 0
+            for chunk in chunks:
+                if columns is None:
+                    columns = list(chunk.columns)
+                for idx, c in enumerate(columns):
+                    np.save(
+                        os.path.join(tmpdir, 'c{}_{}.npy'.format(idx, nchunks)),
+                        chunk[c].values, allow_pickle=False
+                    )
+                nchunks += 1
+            if columns is None:
+                return False
+            stamp = self._src_stamp(srcfile)
+
+            def write(fh):
+                with zipfile.ZipFile(fh, 'w', zipfile.ZIP_STORED) as zf:
+                    for idx in range(len(columns)):
+                        parts = [
+                            np.load(
+                                os.path.join(tmpdir, 'c{}_{}.npy'.format(idx, n)),
+                                mmap_mode='r'
+                            ) for n in range(nchunks)
+                        ]
+                        dtype = np.result_type(*parts)
+                        with zf.open('c{}.npy'.format(idx), 'w', force_zip64=True) as zfh:
+                            np.lib.format.write_array_header_2_0(zfh, {
+                                'descr': np.lib.format.dtype_to_descr(dtype),
+                                'fortran_order': False,
+                                'shape': (sum(len(p) for p in parts),)
+                            })
+                            for p in parts:
+                                zfh.write(
+                                    np.ascontiguousarray(p, dtype=dtype).tobytes()
+                                )
+                        del parts
+                    for name, a in (
+                            ('_columns', np.array(columns, dtype=str)),
+                            ('_stamp', stamp)
+                        ):
+                        with zf.open('{}.npy'.format(name), 'w') as zfh:
+                            np.lib.format.write_array(zfh, a, allow_pickle=False)
+
+            return atomic_write(self.cache_fname(srcfile, key), write)
+        except (OSError, ValueError):  # ValueError for non-numeric columns
+            return False
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+class LRUCache():
+    '''A thread-safe in-memory cache that holds at most maxsize values and
+discards the least recently used value when full.'''
+    def __init__(self, maxsize=8, *args, **kwargs):
+        super(LRUCache, self).__init__(*args, **kwargs)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def get(self, key, default=None):
+        '''Return the value for key and mark it as most recently used, or
+return default if key is not in the cache.'''
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key]
+
+    def put(self, key, value):
+        '''Add value to the cache as key.'''
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        '''Remove all values from the cache.'''
+        with self._lock:
+            self._data.clear()
+
+def _envelope_of(au):
+    '''Return the envelope.EnvelopePyramid of audio au.'''
+    return envelope.EnvelopePyramid(au)
+
+class UtteranceCache():
+    '''A mixin for data loaders that keeps loaded utterances in an in-memory
+LRU cache of utt_cache_size (speaker, utterance, rep, channel) entries, which
+can be filled ahead of time in background threads with prefetch() or
+prefetch_neighbors(). Each entry holds the sample rate, audio, articulation
+DataFrame, and the EnvelopePyramid of the audio that ChannelWidget draws the
+waveform from, so that nothing has to be computed on the GUI thread.
+
+Classes that use it provide utt_key(), get_audio(), get_speaker_utt(),
+get_utterance_list_for_speaker(), and get_rep_list_for_speaker_utterance().'''
+    def __init__(self, utt_cache_size=8, *args, **kwargs):
+        super(UtteranceCache, self).__init__(*args, **kwargs)
+        self.utt_cache = LRUCache(maxsize=utt_cache_size)
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=2)
+        # Audio is read and its envelope built here while the articulation
+        # data are read in the
+        # thread that loads the utterance. This must not be the
+        # prefetch_executor, whose threads wait for the audio.
+        self.audio_executor = ThreadPoolExecutor(max_workers=4)
+        self._prefetching = {}   # Futures of utterances being prefetched
+        self._prefetch_lock = threading.Lock()
+
+    def get_cached_utt(self, speakerid, dataname, rep, channel):
+        '''Return (rate, audio, datadf, envelope) for an utterance if it is in
+the utt_cache, otherwise None.'''
+        return self.utt_cache.get(self.utt_key(speakerid, dataname, rep, channel))
+
+    def cache_utt(self, speakerid, dataname, rep, channel, rate, au, datadf,
+                  envelope=None):
+        '''Add an utterance loaded elsewhere to the utt_cache. The envelope of
+au is built if it is not given.'''
+        if envelope is None:
+            envelope = _envelope_of(au)
+        self.utt_cache.put(
+            self.utt_key(speakerid, dataname, rep, channel),
+            (rate, au, datadf, envelope)
+        )
+
+    def load_utt(self, speakerid, dataname, rep, channel):
+        '''Return (rate, audio, datadf, envelope) for an utterance from the
+utt_cache, or load it with get_audio() and get_speaker_utt(), build the
+EnvelopePyramid of the audio, and add it to the cache. If the utterance is
+being prefetched, wait for the prefetch to finish.'''
+        key = self.utt_key(speakerid, dataname, rep, channel)
+        with self._prefetch_lock:
+            fut = self._prefetching.get(key)
+        if fut is not None:
+            return fut.result()
+        return self._load_utt(key)
+
+    def _load_utt(self, key):
+        '''Load the utterance for an utt_cache key, unless it is cached. The
+audio is read and its envelope built concurrently with reading the
+articulation data.'''
+        utt = self.utt_cache.get(key)
+        if utt is None:
+            (spkr, dataname, rep, channel) = key
+            aufut = self.audio_executor.submit(
+                self._load_audio, spkr, dataname, rep, channel
+            )
+            try:
+                datadf = self.get_speaker_utt(spkr, dataname, rep)
+            finally:
+                rate, au, envelope = aufut.result()
+            utt = (rate, au, datadf, envelope)
+            self.utt_cache.put(key, utt)
+        return utt
+
+    def _load_audio(self, speakerid, dataname, rep, channel):
+        '''Return the rate, audio and EnvelopePyramid of an utterance.'''
+        rate, au = self.get_audio(speakerid, dataname, rep, channel)
+        return (rate, au, _envelope_of(au))
+
+    def prefetch(self, speakerid, dataname, rep, channel):
+        '''Load an utterance into the utt_cache in a background thread.'''
+        key = self.utt_key(speakerid, dataname, rep, channel)
+        with self._prefetch_lock:
+            if key in self._prefetching or key in self.utt_cache:
+                return
+            fut = self.prefetch_executor.submit(self._load_utt, key)
+            self._prefetching[key] = fut
+        fut.add_done_callback(lambda f: self._prefetch_done(key))
+
+    def _prefetch_done(self, key):
+        with self._prefetch_lock:
+            self._prefetching.pop(key, None)
+
+    def prefetch_neighbors(self, speakerid, dataname, rep, channel, next_utt=False):
+        '''Prefetch the repetitions before and after rep of an utterance. If
+next_utt is True, also prefetch the first repetition of the next utterance.'''
+        reps = self.get_rep_list_for_speaker_utterance(speakerid, dataname)
+        rep = self.utt_key(speakerid, dataname, rep, channel)[2]
+        if rep in reps:
+            idx = reps.index(rep)
+            for nidx in (idx + 1, idx - 1):
+                if 0 <= nidx < len(reps):
+                    self.prefetch(speakerid, dataname, reps[nidx], channel)
+        if next_utt is True:
+            utts = self.get_utterance_list_for_speaker(speakerid)
+            idx = utts.index(dataname)
+            if idx + 1 < len(utts):
+                nextutt = utts[idx + 1]
+                nextreps = self.get_rep_list_for_speaker_utterance(
+                    speakerid, nextutt
+                )
+                if len(nextreps) > 0:
+                    self.prefetch(speakerid, nextutt, nextreps[0], channel)
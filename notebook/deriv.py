@@ -0,0 +1,101 @@
+import numpy as np
+import scipy.signal
+
+class Derivatives():
+    '''Lazily computed derivatives of the coordinate columns of a DataFrame
+with a 'sec' column.
+
+Derivatives are calculated only for the columns that are requested, are
+scaled by the sample interval so that they are in units per second, and are
+memoized per (column, order, filter). The filter is one of:
+
+'savgol': Savitzky-Golay smoothing differentiator with window and polyorder,
+    using the median sample interval.
+'central': Central differences (np.gradient) using the actual sample times.
+'diff': Backward differences, like DataFrame.diff(), divided by the sample
+    interval. The first value is NaN.
+'''
+    def __init__(self, df, method='savgol', window=7, polyorder=2, *args, **kwargs):
+        super(Derivatives, self).__init__(*args, **kwargs)
+        self.df = df
+        self.sec = df.sec.values
+        self.method = method
+        self.window = window
+        self.polyorder = polyorder
+        self._memo = {}
+
+    def _filter(self, method, window, polyorder):
+        '''Return the filter key for method and parameters, using defaults
+for those that are None.'''
+        method = self.method if method is None else method
+        if method == 'savgol':
+            window = self.window if window is None else window
+            polyorder = self.polyorder if polyorder is None else polyorder
+            if window > len(self.sec):
+                # Too few samples to smooth; fall back to central differences.
+                return ('central', None, None)
+            return (method, window, polyorder)
+        elif method in ('central', 'diff'):
+            return (method, None, None)
+        raise ValueError('Unrecognized derivative method {}.'.format(method))
+
+    def _calc(self, y, order, filt):
+        '''Return derivatives of order of the columns of 2-d array y.'''
+        method, window, polyorder = filt
+        if len(y) < 2:
+            return np.full(y.shape, np.nan)
+        if method == 'savgol':
+            # The default 'interp' mode fits the edges by least squares, which
+            # fails on NaN, so columns with NaN (e.g. bad values) use 'nearest'
+            # edges and the NaN only spread to the neighboring samples.
+            finite = np.all(np.isfinite(y), axis=0)
+            d = np.empty(y.shape)
+            for mode, cols in (('interp', finite), ('nearest', ~finite)):
+                if np.any(cols):
+                    d[:, cols] = scipy.signal.savgol_filter(
+                        y[:, cols], window, polyorder, deriv=order,
+                        delta=np.median(np.diff(self.sec)), axis=0, mode=mode
+                    )
+            return d
+        for _ in range(order):
+            if method == 'central':
+                y = np.gradient(y, self.sec, axis=0)
+            else:
+                dy = np.full(y.shape, np.nan)
+                dy[1:] = np.diff(y, axis=0) / np.diff(self.sec)[:, np.newaxis]
+                y = dy
+        return y
+
+    def derivative(self, cols, order=1, method=None, window=None, polyorder=None):
+        '''Return derivatives of order of cols, which is a column name or a
+list of column names. A 1-d array is returned for a single column name,
+otherwise a 2-d array with one column per name.'''
+        single = isinstance(cols, str)
+        if single:
+            cols = [cols]
+        filt = self._filter(method, window, polyorder)
+        todo = [c for c in cols if (c, order, filt) not in self._memo]
+        if len(todo) > 0:
+            y = self.df[todo].values.astype(float)
+            d = self._calc(y, order, filt)
+            for idx, c in enumerate(todo):
+                self._memo[(c, order, filt)] = d[:, idx]
+        if single:
+            return self._memo[(cols[0], order, filt)]
+        return np.column_stack([self._memo[(c, order, filt)] for c in cols])
+
+    def velocity(self, cols, **kwargs):
+        '''Return the velocity of cols. See derivative().'''
+        return self.derivative(cols, order=1, **kwargs)
+
+    def acceleration(self, cols, **kwargs):
+        '''Return the acceleration of cols. See derivative().'''
+        return self.derivative(cols, order=2, **kwargs)
+
+    def speed(self, element, dims=None, **kwargs):
+        '''Return the speed of element, i.e. the magnitude of its velocity in
+dims. By default all of the element's x, y, and z columns are used.'''
+        if dims is None:
+            dims = [d for d in 'xyz' if '{}_{}'.format(element, d) in self.df.columns]
+        vel = self.velocity(['{}_{}'.format(element, d) for d in dims], **kwargs)
+        return np.sqrt(np.sum(vel ** 2, axis=1))
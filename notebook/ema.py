@@ -1,7 +1,11 @@
-import os, re
+import os, re, struct, threading, json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 import scipy.io.wavfile
 import wavio
+from datacache import ColumnarCache, UtteranceCache, atomic_write, default_cachedir
+from deriv import Derivatives
 
 def speaker_as_int_str(speaker):
     '''Take a speaker identifier and return the speaker as an str
@@ -17,44 +21,268 @@ representing an integer. Speaker identifiers may be strings like 'Subject_4',
         int_str = str(speaker)
     return int_str
 
-class EmaEcogDataLoader():
-    '''A class for loading EMA-ECOG data.'''
-    def __init__(self, datadir, *args, **kwargs):
-        super(EmaEcogDataLoader, self).__init__(*args, **kwargs)
+def iter_with_vel(chunks, coordcols=None):
+    '''Yield the DataFrames in the iterable chunks with velocities of the
+coordinate columns added as <coordinate>_vel columns. Velocities are backward
+differences in units per second, calculated by deriv.Derivatives with the
+'diff' method from the 'sec' column. The velocity of the first row of a chunk
+is calculated from the last row of the previous chunk, so the result is the
+same as when the whole file is read at once. If coordcols is None all _x, _y,
+and _z columns are used.'''
+    prev = None
+    for chunk in chunks:
+        if coordcols is None:
+            coordcols = [c for c in chunk.columns if c[-2:] in ['_x', '_y', '_z']]
+        coords = chunk[['sec'] + coordcols]
+        if prev is not None:
+            coords = pd.concat([prev, coords], ignore_index=True)
+        vel = Derivatives(coords, method='diff').velocity(coordcols)
+        if len(chunk) > 0:
+            prev = coords.iloc[-1:]
+        yield chunk.join(pd.DataFrame(
+            vel[len(coords) - len(chunk):],
+            index=chunk.index,
+            columns=['{}_vel'.format(c) for c in coordcols]
+        ))
+
+def compact_int(s):
+    '''Return the Series s, whose values must be integers or NA, in the
+smallest integer dtype that holds all of its values. The dtype is a pandas
+nullable integer dtype (e.g. Int8) if s has NA values. s is returned
+unchanged if it has values that are not integers.'''
+    vals = s.dropna().values
+    if len(vals) > 0 and not np.all(np.mod(vals, 1) == 0):
+        return s
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if len(vals) == 0 or (vals.min() >= info.min and vals.max() <= info.max):
+            break
+    if len(vals) < len(s):
+        return s.astype('Int{}'.format(info.bits))
+    return s.astype(dtype)
+
+def time_normalized_frames(df, elements, dims='xyz', nframes=100):
+    '''Return the coordinates of elements in df, linearly interpolated at
+nframes equally spaced points from the first to the last row, as a float32
+array of shape (nframes, len(elements), len(dims)). Coordinate columns are
+named <element>_<dim>; missing columns are NaN.'''
+    cols = ['{}_{}'.format(el, d) for el in elements for d in dims]
+    vals = df.reindex(columns=cols).values.astype(np.float32)
+    if len(vals) == 0:
+        return np.full((nframes, len(elements), len(dims)), np.nan, dtype=np.float32)
+    # Fractional row positions of the normalized frames, interpolated between
+    # neighbouring rows for all columns at once.
+    pos = np.linspace(0, len(vals) - 1, nframes)
+    i0 = np.clip(np.floor(pos).astype(int), 0, max(len(vals) - 2, 0))
+    i1 = np.minimum(i0 + 1, len(vals) - 1)
+    w = (pos - i0)[:, np.newaxis].astype(np.float32)
+    out = vals[i0] * (1 - w) + vals[i1] * w
+    return out.reshape(nframes, len(elements), len(dims))
+
+def read_wav_channel(fname, channel):
+    '''Read one channel of a PCM or float .wav file without reading the other
+channels. Return sample rate and audio data. The audio data is a strided view
+of a read-only memory map of the file for all sample widths except 24-bit, which
+are converted to sign-extended int32 like wavio does.
+
+Files written by the NDI system can have an invalid data chunk size, like the
+files handled by wavio. In that case the data are assumed to extend to the end
+of the file.'''
+    fsize = os.path.getsize(fname)
+    fmt = None
+    with open(fname, 'rb') as fh:
+        riff, _, wave = struct.unpack('<4sI4s', fh.read(12))
+        if riff != b'RIFF' or wave != b'WAVE':
+            raise ValueError('{} is not a RIFF WAVE file.'.format(fname))
+        while True:
+            hdr = fh.read(8)
+            if len(hdr) < 8:
+                raise ValueError('No data chunk found in {}.'.format(fname))
+            chunkid, size = struct.unpack('<4sI', hdr)
+            if chunkid == b'fmt ':
+                fmtbytes = fh.read(size)
+                (tag, nchannels, rate, _, blockalign, bits) = \
+                    struct.unpack('<HHIIHH', fmtbytes[:16])
+                if tag == 0xFFFE:  # WAVE_FORMAT_EXTENSIBLE
+                    tag = struct.unpack('<H', fmtbytes[24:26])[0]
+                fmt = (tag, nchannels, rate, blockalign, bits)
+                fh.seek(size % 2, 1)
+            elif chunkid == b'data':
+                offset = fh.tell()
+                break
+            else:
+                fh.seek(size + size % 2, 1)
+    if fmt is None:
+        raise ValueError('No fmt chunk found in {}.'.format(fname))
+    (tag, nchannels, rate, blockalign, bits) = fmt
+    if size == 0 or offset + size > fsize:  # Broken data chunk size.
+        size = fsize - offset
+    nframes = size // blockalign
+    dtypes = {
+        (1, 8): np.uint8, (1, 16): '<i2', (1, 32): '<i4',
+        (3, 32): '<f4', (3, 64): '<f8'
+    }
+    if (tag, bits) in dtypes:
+        mm = np.memmap(
+            fname, dtype=dtypes[(tag, bits)], mode='r', offset=offset,
+            shape=(nframes, nchannels)
+        )
+        return (rate, mm[:, channel])
+    elif (tag, bits) == (1, 24):
+        mm = np.memmap(
+            fname, dtype=np.uint8, mode='r', offset=offset,
+            shape=(nframes, blockalign)
+        )
+        b = mm[:, channel * 3:channel * 3 + 3].astype(np.int32)
+        data = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+        return (rate, (data ^ 0x800000) - 0x800000)
+    else:
+        # Fall back to wavio for formats we can't map.
+        w = wavio.read(fname)
+        return (w.rate, w.data[:, channel])
+
+class EmaEcogDataLoader(UtteranceCache):
+    '''A class for loading EMA-ECOG data.
+
+Parsed .ndi files are cached in binary form in cachedir, which defaults to a
+directory for datadir in the user's cache directory, or to a '.articuvis_cache'
+directory in datadir if cache_in_datadir is True (see
+datacache.default_cachedir). Set use_cache to False to always parse the .ndi
+text files.
+
+Loaded utterances are kept in an in-memory LRU cache of utt_cache_size
+(speaker, utterance, rep, channel) entries, which can be filled ahead of time
+in background threads with prefetch() or prefetch_neighbors(). See
+datacache.UtteranceCache.
+
+If lazy is True only the subject directories are listed at startup, and each
+subject's utterances and reps are found the first time they are requested.'''
+    def __init__(self, datadir, cachedir=None, use_cache=True,
+                 cache_in_datadir=False, utt_cache_size=8, lazy=True,
+                 *args, **kwargs):
+        super(EmaEcogDataLoader, self).__init__(
+            utt_cache_size=utt_cache_size, *args, **kwargs
+        )
         self.datadir = datadir
-        self.speaker_map = self.get_speaker_map()
+        if cachedir is None:
+            cachedir = default_cachedir(datadir, cache_in_datadir)
+        self.cache = ColumnarCache(cachedir) if use_cache is True else None
+        self._palate_cache = {}
+        self._palate_lock = threading.Lock()
+        self.palate_cache_hits = 0
+        self.palate_cache_misses = 0
+        self._speaker_map_lock = threading.Lock()
+        self._speaker_index = {}
+        self.speaker_map = self.get_speaker_map(lazy=lazy)
 
-    def get_speaker_map(self):
+    def get_speaker_map(self, workers=4, lazy=False):
         '''Find subject directories in datadir and return a dict that maps subject
-numbers to utterances and repetitions.'''
+numbers to utterances and repetitions.
+
+If the binary cache is enabled the map is also stored in an index file in the
+cache directory, along with the modification time of each subject directory.
+Only subjects whose directories have changed since the index was written are
+scanned again, in up to workers parallel threads. If lazy is True, changed
+subjects are not scanned and map to None; use subject_utterances() to scan
+them when needed.'''
         ddir = self.datadir
-        spkrmap = {}
-        snre = re.compile(r'Subject_(\d+)$')
-        dirs = [
-            os.path.join(ddir, o) for o in os.listdir(ddir) \
-                if os.path.isdir(os.path.join(ddir, o))
-        ]
-        for d in dirs:
-            m = snre.search(d)
-            if m:
-                spkrnum = m.group(1)
-                tokenre = re.compile(r'^SN{}_(.+)_(\d+)\.ndi$'.format(spkrnum))
-                utterances = {}
-                for f in os.listdir(d):
-                    tm = tokenre.search(f)
-                    if tm and os.path.isfile(os.path.join(self.datadir, d, f)):
-                        utt = tm.group(1)
-                        rep = tm.group(2)
-                        try:
-                            utterances[utt].append(rep)
-                        except KeyError:
-                            utterances[utt] = [rep]
-                spkrmap[spkrnum] = utterances
-        return spkrmap
+        snre = re.compile(r'^Subject_(\d+)$')
+        index = self._read_speaker_index()
+        newindex = {}
+        toscan = []
+        with os.scandir(ddir) as it:
+            for entry in it:
+                m = snre.search(entry.name)
+                if m and entry.is_dir():
+                    mtime = entry.stat().st_mtime_ns
+                    spkrnum = m.group(1)
+                    try:
+                        assert(index[spkrnum]['mtime'] == mtime)
+                        assert('utterances' in index[spkrnum])
+                        newindex[spkrnum] = index[spkrnum]
+                    except (KeyError, AssertionError):
+                        newindex[spkrnum] = {'mtime': mtime}
+                        toscan.append(spkrnum)
+        if len(toscan) > 0 and lazy is not True:
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                scanned = executor.map(self.scan_subject, toscan)
+                for spkrnum, utterances in zip(toscan, scanned):
+                    newindex[spkrnum]['utterances'] = utterances
+        if newindex != index:
+            self._write_speaker_index(newindex)
+        self._speaker_index = newindex
+        return {
+            spkrnum: v.get('utterances') for spkrnum, v in newindex.items()
+        }
 
-    def get_audio(self, speakerid, dataname, rep, channel):
-        '''Read a UCSF EMA (ECOG) speaker audio file. Return sample rate and
-audio data as a numpy array.
+    def subject_utterances(self, speakerid):
+        '''Return a dict that maps the utterances of a speaker to lists of
+their repetitions. The subject directory is scanned the first time the
+speaker is requested if it was not in the index.'''
+        spkr_int_str = speaker_as_int_str(speakerid)
+        with self._speaker_map_lock:
+            utterances = self.speaker_map[spkr_int_str]
+            if utterances is None:
+                utterances = self.scan_subject(spkr_int_str)
+                self.speaker_map[spkr_int_str] = utterances
+                self._speaker_index[spkr_int_str]['utterances'] = utterances
+                self._write_speaker_index(self._speaker_index)
+        return utterances
+
+    def scan_subject(self, spkrnum):
+        '''Return a dict that maps the utterances in a subject directory to
+lists of their repetitions.'''
+        d = os.path.join(self.datadir, 'Subject_{}'.format(spkrnum))
+        tokenre = re.compile(r'^SN{}_(.+)_(\d+)\.ndi$'.format(spkrnum))
+        utterances = {}
+        for f in os.listdir(d):
+            tm = tokenre.search(f)
+            if tm and os.path.isfile(os.path.join(d, f)):
+                utt = tm.group(1)
+                rep = tm.group(2)
+                try:
+                    utterances[utt].append(rep)
+                except KeyError:
+                    utterances[utt] = [rep]
+        return utterances
+
+    @property
+    def speaker_index_fname(self):
+        '''Return the name of the speaker map index file, or None if the
+binary cache is disabled.'''
+        if self.cache is None:
+            return None
+        return os.path.join(self.cache.cachedir, 'speaker_index.json')
+
+    def _read_speaker_index(self):
+        '''Return the speaker map index, or an empty dict if there is none.'''
+        try:
+            with open(self.speaker_index_fname, 'r') as fh:
+                index = json.load(fh)
+            assert(index['datadir'] == os.path.abspath(self.datadir))
+            return index['subjects']
+        except (TypeError, OSError, ValueError, KeyError, AssertionError):
+            return {}
+
+    def _write_speaker_index(self, index):
+        '''Write the speaker map index with datacache.atomic_write().'''
+        fname = self.speaker_index_fname
+        if fname is None:
+            return False
+        return atomic_write(
+            fname,
+            lambda fh: json.dump(
+                {'datadir': os.path.abspath(self.datadir), 'subjects': index},
+                fh
+            ),
+            mode='w'
+        )
+
+    def utt_fname(self, speakerid, dataname, rep, ext):
+        '''Return the name of a UCSF EMA (ECOG) speaker utterance file.
+The directory name is formed from datadir and speaker.
+The filename is formed from speaker, dataname, the repetition (rep), and the
+extension ext. The rep parameter can be a string or an integer.
 '''
         if rep is None or rep == '':
             rep = ''
@@ -64,24 +292,52 @@ audio data as a numpy array.
             elif not rep.startswith('_'):
                 rep = '_' + rep
         spkr_int_str = speaker_as_int_str(speakerid)
-        fname = os.path.join(
+        return os.path.join(
             self.datadir,
             'Subject_{}'.format(spkr_int_str),
-            'SN{}_{}{}.wav'.format(spkr_int_str, dataname, rep)
+            'SN{}_{}{}.{}'.format(spkr_int_str, dataname, rep, ext)
         )
-        # Use wavio for broken .wav files
-        w = wavio.read(fname)
-        return (w.rate, w.data[:, channel])
+
+    def get_audio(self, speakerid, dataname, rep, channel):
+        '''Read a UCSF EMA (ECOG) speaker audio file. Return sample rate and
+audio data as a numpy array.
+'''
+        fname = self.utt_fname(speakerid, dataname, rep, 'wav')
+        # Map the file instead of reading all channels. This also handles the
+        # broken .wav files we used to read with wavio.
+        return read_wav_channel(fname, channel)
 #        return scipy.io.wavfile.read(fname)
     
-    def get_palate_trace(self, speakerid, trange, dataname='Palate', element='PL', xdim=None, ydim=None, **kwargs):
-        '''Read a palate data file and return a landmark dataframe of columns 'x' and 'y', plus 'landmark' column. kwargs (like rep) will be passed to get_speaker_utt().'''
-        paldf = self.get_speaker_utt(
-            speakerid, dataname, **kwargs
+    def get_palate_trace(self, speakerid, trange, dataname='Palate', element='PL', xdim=None, ydim=None, rep=None, drop_prefixes=['EMPTY']):
+        '''Read a palate data file and return a landmark dataframe of columns 'x' and 'y', plus 'landmark' column. rep and drop_prefixes are used as in get_speaker_utt().
+
+The sec and coordinate columns of element are cached per speaker, so calls
+that differ only in trange, xdim, or ydim don't read the file again.'''
+        key = (
+            speaker_as_int_str(speakerid), dataname, element,
+            self.utt_key(speakerid, dataname, rep, 0)[2], tuple(drop_prefixes)
         )
-        tracetimes = (paldf.sec > trange[0]) & (paldf.sec < trange[1])
+        with self._palate_lock:
+            paldf = self._palate_cache.get(key)
+            if paldf is None:
+                self.palate_cache_misses += 1
+            else:
+                self.palate_cache_hits += 1
+        if paldf is None:
+            fname = self.utt_fname(speakerid, dataname, rep, 'ndi')
+            paldf = self.read_ndi(fname, drop_prefixes=drop_prefixes)
+            cols = ['sec'] + [
+                '{}_{}'.format(element, d) for d in 'xyz'
+                if '{}_{}'.format(element, d) in paldf.columns
+            ]
+            paldf = paldf.loc[:, cols]
+            with self._palate_lock:
+                self._palate_cache[key] = paldf
+        sec = paldf.sec.values
+        i0 = np.searchsorted(sec, trange[0], side='right')
+        i1 = np.searchsorted(sec, trange[1], side='left')
         palcols = ['{}_{}'.format(element, xdim), '{}_{}'.format(element, ydim)]
-        landmarkdf = paldf.loc[tracetimes, palcols]
+        landmarkdf = paldf.iloc[i0:i1].loc[:, palcols]
         landmarkdf.columns = ['x', 'y']
         landmarkdf = landmarkdf.assign(
             landmark=['palate'] * len(landmarkdf)
@@ -94,35 +350,88 @@ The directory name is formed from datadir and speaker.
 The filename is formed from speaker, dataname, and the repetition (rep). The
 rep parameter can be a string or an integer.
 '''
-        if rep is None or rep == '':
-            rep = ''
-        else:
-            if not isinstance(rep, str):  # if rep is passed as an int
-                rep = '_{:03d}'.format(rep)
-            elif not rep.startswith('_'):
-                rep = '_' + rep
-        spkr_int_str = speaker_as_int_str(speakerid)
-        fname = os.path.join(
-            self.datadir,
-            'Subject_{}'.format(spkr_int_str),
-            'SN{}_{}{}.ndi'.format(spkr_int_str, dataname, rep)
-        )
-    
+        fname = self.utt_fname(speakerid, dataname, rep, 'ndi')
+        # Velocities are not calculated here. Use deriv.Derivatives to
+        # calculate them for the columns that are needed.
+        return self.read_ndi(fname, drop_prefixes=drop_prefixes)
+
+    def read_ndi(self, fname, drop_prefixes=['EMPTY']):
+        '''Read an .ndi file into a DataFrame, dropping columns that start with
+one of drop_prefixes and renaming 'time' to 'sec'. The result is read from
+and stored in the binary cache if it is enabled.'''
+        key = tuple(drop_prefixes)
+        if self.cache is not None:
+            df = self.cache.load(fname, key)
+            if df is not None:
+                return df
         df = pd.read_csv(fname, sep='\t')
         to_drop = [c for name in drop_prefixes for c in df.columns if c.startswith(name)]
         df = df.drop(to_drop, axis=1)
 
         if 'time' in df.columns:
             df = df.rename(columns={'time': 'sec'})
-
-        # Calculate velocities for all coordinate columns and add as
-        # <coordinate>_vel columns.
-        coordcols = [c for c in df.columns if c[-2:] in ['_x', '_y', '_z']]
-# TODO: smooth data before diff()
-# TODO: don't calculate *_vel columns in this function
-        df = df.join(df[coordcols].diff(), rsuffix='_vel')
+        if self.cache is not None:
+            self.cache.save(fname, df, key)
         return df
 
+    def iter_ndi(self, fname, chunksize=100000, drop_prefixes=['EMPTY']):
+        '''Yield an .ndi file as DataFrames of chunksize rows, with columns
+dropped and renamed as in read_ndi(). The binary cache is not used.'''
+        for chunk in pd.read_csv(fname, sep='\t', chunksize=chunksize):
+            to_drop = [c for name in drop_prefixes for c in chunk.columns if c.startswith(name)]
+            chunk = chunk.drop(to_drop, axis=1)
+            if 'time' in chunk.columns:
+                chunk = chunk.rename(columns={'time': 'sec'})
+            yield chunk
+
+    def iter_speaker_utt(self, speakerid, dataname, rep=None, chunksize=100000, drop_prefixes=['EMPTY']):
+        '''Yield a UCSF EMA (ECOG) speaker utterance as DataFrames of chunksize
+rows, with the columns of get_speaker_utt() plus <coordinate>_vel columns
+calculated across chunk boundaries by iter_with_vel(). Use this to process
+very long recordings in bounded memory.'''
+        fname = self.utt_fname(speakerid, dataname, rep, 'ndi')
+        return iter_with_vel(
+            self.iter_ndi(fname, chunksize=chunksize, drop_prefixes=drop_prefixes)
+        )
+
+    def build_cache(self, drop_prefixes=['EMPTY'], chunksize=None, verbose=False):
+        '''Parse every .ndi file in datadir and store it in the binary cache.
+Files that already have a valid cache entry are not parsed again. Return the
+number of files that were parsed. If chunksize is not None, files are read
+and cached chunksize rows at a time, which bounds memory use for very long
+recordings.'''
+        if self.cache is None:
+            raise RuntimeError('The binary cache is disabled.')
+        nparsed = 0
+        ndire = re.compile(r'^SN\d+_.+\.ndi$')
+        for spkr in self.get_speaker_list():
+            sdir = os.path.join(self.datadir, 'Subject_{}'.format(spkr))
+            for f in sorted(os.listdir(sdir)):
+                fname = os.path.join(sdir, f)
+                if not ndire.search(f) or not os.path.isfile(fname):
+                    continue
+                if not self.cache.is_valid(fname, tuple(drop_prefixes)):
+                    if verbose is True:
+                        print('caching {}'.format(fname))
+                    if chunksize is None:
+                        self.read_ndi(fname, drop_prefixes=drop_prefixes)
+                    else:
+                        self.cache.save_chunks(
+                            fname,
+                            self.iter_ndi(fname, chunksize, drop_prefixes),
+                            tuple(drop_prefixes)
+                        )
+                    nparsed += 1
+        return nparsed
+
+    def utt_key(self, speakerid, dataname, rep, channel):
+        '''Return the utt_cache key for an utterance and audio channel.'''
+        if rep is None:
+            rep = ''
+        elif not isinstance(rep, str):  # if rep is passed as an int
+            rep = '{:03d}'.format(rep)
+        return (speaker_as_int_str(speakerid), dataname, rep.lstrip('_'), int(channel))
+
     def get_speaker_list(self, sorted=True):
         '''Return a list of speakers, sorted by speaker number.'''
         spkrs = list(self.speaker_map.keys())
@@ -132,73 +441,411 @@ rep parameter can be a string or an integer.
 
     def get_utterance_list_for_speaker(self, speakerid, sorted=True):
         '''Return a list of utterances for a speaker.'''
-        spkr_int_str = speaker_as_int_str(speakerid)
-        utts = list(self.speaker_map[spkr_int_str].keys())
+        utts = list(self.subject_utterances(speakerid).keys())
         if sorted is True:
             utts.sort()
         return utts
         
     def get_rep_list_for_speaker_utterance(self, speakerid, utt, sorted=True):
         '''Return a list of for a speaker utterance.'''
-        spkr_int_str = speaker_as_int_str(speakerid)
-        rep = list(self.speaker_map[spkr_int_str][utt])
+        rep = list(self.subject_utterances(speakerid)[utt])
         if sorted is True:
             rep.sort(key=lambda x: int(x))
         return rep
 
-def read_marquette_speaker_data(basepath, speaker, dataname):
-    '''Read Marquette EMA speaker data from a directory.'''
-    spkpath = os.path.join(basepath, speaker)
-
-    sensors = ["REF","TD","TL","TB","UL","LL","LC","MI","PL","OS","MS","UNK0","UNK1"]
-    subcolumns = ["ID","Status","x","y","z","q0","qx","qy","qz"]
-    better_head = \
-        ['sec', 'measid', 'wavid'] + \
-        ['{}_{}'.format(s, c) for s in sensors for c in subcolumns]
-    coordcols = [
-        '{}_{}'.format(s, d) for s in sensors for d in ['x', 'y', 'z']
-    ]
-
-    read_csv_kwargs = dict(
-        sep='\t',
-        header=None,            # The last three parameters
-        skiprows=1,             # are used to override
-        names=better_head       # the existing file header.
-    )
+    def get_rep_stack(self, speakerid, dataname, reps=None, elements=None,
+                      dims='xyz', nframes=100, workers=4, drop_prefixes=['EMPTY'],
+                      progress=None, is_cancelled=None):
+        '''Load repetitions of an utterance and return them time-normalized
+in one float32 array of shape (len(reps), nframes, len(elements), len(dims)),
+along with the lists of elements and reps. By default all reps are loaded,
+and elements are those of the first rep. See time_normalized_frames().
 
-    datadf = pd.read_csv(
-        os.path.join(spkpath, 'Data', '{}_{}.tsv'.format(speaker, dataname)),
-        **read_csv_kwargs
-    )
-    # Calculate velocities for all coordinate columns and add as <coordinate>_vel columns.
-    datadf = datadf.join(datadf[coordcols].diff(), rsuffix='_vel')
-
-    paldf = pd.read_csv(
-        os.path.join(
-            spkpath, 'Calibration', 'Palate',
-            '{}_palatetrace.tsv'.format(speaker)
-        ),
-        **read_csv_kwargs
-    )
+Reps are loaded in up to workers parallel threads, and each is normalized as
+soon as it is loaded, so only the normalized arrays of all reps and the data
+of up to workers reps are held in memory at once. The utt_cache is not used.
 
-    bpdf = pd.read_csv(
-        os.path.join(
-            spkpath, 'Calibration', 'Biteplate',
-            '{}_Biteplate.tsv'.format(speaker)
-        ),
-        **read_csv_kwargs
-    )
+If progress is not None it is called with the number of reps done and the
+total number of reps each time a rep is done. If is_cancelled is not None it
+is called before each rep is loaded, and if it returns True the reps that are
+not loaded yet are skipped and None is returned.'''
+        if reps is None:
+            reps = self.get_rep_list_for_speaker_utterance(speakerid, dataname)
+        reps = list(reps)
+        if elements is None and len(reps) > 0:
+            df = self.get_speaker_utt(speakerid, dataname, reps[0], drop_prefixes)
+            elements = [c[:-2] for c in df.columns if c.endswith('_x')]
+        stack = np.full(
+            (len(reps), nframes, len(elements or []), len(dims)),
+            np.nan,
+            dtype=np.float32
+        )
+
+        def load(rep):
+            if is_cancelled is not None and is_cancelled():
+                return None
+            return time_normalized_frames(
+                self.get_speaker_utt(speakerid, dataname, rep, drop_prefixes),
+                elements, dims=dims, nframes=nframes
+            )
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            futures = {executor.submit(load, rep): idx for idx, rep in enumerate(reps)}
+            for ndone, fut in enumerate(as_completed(futures), 1):
+                frames = fut.result()
+                if frames is None:  # Cancelled
+                    for f in futures:
+                        f.cancel()
+                    return None
+                stack[futures[fut]] = frames
+                if progress is not None:
+                    progress(ndone, len(reps))
+        return (stack, elements, reps)
+
+def quat_to_rotmat(q):
+    '''Return rotation matrices for the quaternions in q, an array with shape
+(..., 4) of (q0, qx, qy, qz) values with scalar q0 first. The quaternions are
+normalized first. The result has shape (..., 3, 3).'''
+    q = np.asarray(q, dtype=np.float64)
+    q = q / np.linalg.norm(q, axis=-1, keepdims=True)
+    w, x, y, z = q[..., 0], q[..., 1], q[..., 2], q[..., 3]
+    R = np.empty(q.shape[:-1] + (3, 3))
+    R[..., 0, 0] = 1 - 2 * (y * y + z * z)
+    R[..., 0, 1] = 2 * (x * y - w * z)
+    R[..., 0, 2] = 2 * (x * z + w * y)
+    R[..., 1, 0] = 2 * (x * y + w * z)
+    R[..., 1, 1] = 1 - 2 * (x * x + z * z)
+    R[..., 1, 2] = 2 * (y * z - w * x)
+    R[..., 2, 0] = 2 * (x * z - w * y)
+    R[..., 2, 1] = 2 * (y * z + w * x)
+    R[..., 2, 2] = 1 - 2 * (x * x + y * y)
+    return R
+
+def rotmat_to_quat(R):
+    '''Return the unit quaternion (q0, qx, qy, qz), with q0 >= 0, of the 3x3
+rotation matrix R.'''
+    R = np.asarray(R, dtype=np.float64)
+    # The quaternion is the eigenvector of the largest eigenvalue of K
+    # (Bar-Itzhack 2000), which is robust to matrices that are not exactly
+    # orthonormal.
+    K = np.array([
+        [R[0, 0] + R[1, 1] + R[2, 2], R[2, 1] - R[1, 2], R[0, 2] - R[2, 0], R[1, 0] - R[0, 1]],
+        [R[2, 1] - R[1, 2], R[0, 0] - R[1, 1] - R[2, 2], R[0, 1] + R[1, 0], R[0, 2] + R[2, 0]],
+        [R[0, 2] - R[2, 0], R[0, 1] + R[1, 0], R[1, 1] - R[0, 0] - R[2, 2], R[1, 2] + R[2, 1]],
+        [R[1, 0] - R[0, 1], R[0, 2] + R[2, 0], R[1, 2] + R[2, 1], R[2, 2] - R[0, 0] - R[1, 1]]
+    ]) / 3.0
+    q = np.linalg.eigh(K)[1][:, -1]
+    return q if q[0] >= 0 else -q
+
+def quat_multiply(a, b):
+    '''Return the Hamilton products of the quaternions in a and b, arrays
+of (q0, qx, qy, qz) values that broadcast against each other.'''
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    aw, ax, ay, az = a[..., 0], a[..., 1], a[..., 2], a[..., 3]
+    bw, bx, by, bz = b[..., 0], b[..., 1], b[..., 2], b[..., 3]
+    return np.stack([
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw
+    ], axis=-1)
+
+# Sensors and per-sensor subcolumns in Marquette EMA .tsv files.
+MARQUETTE_SENSORS = ["REF","TD","TL","TB","UL","LL","LC","MI","PL","OS","MS","UNK0","UNK1"]
+MARQUETTE_SUBCOLUMNS = ["ID","Status","x","y","z","q0","qx","qy","qz"]
+
+class MarquetteSpeaker():
+    '''A class for reading Marquette EMA data and calibration files of a
+speaker. The palate, biteplate, and rotation calibration files are read the
+first time they are used.
+
+Only the columns that are needed are parsed. The 'sec' column and the x, y,
+and z columns of sensors are always read; sensors defaults to all sensors
+except UNK0 and UNK1. The measid, wavid, and sensor ID columns are read if
+with_ids is True, the sensor Status columns if with_status is True, and the
+sensor quaternion columns if with_quats is True. Coordinate and quaternion
+columns are converted to dtype. Status columns have the dtype that pandas
+infers, unless compact_status is True, in which case they are converted to the
+smallest integer dtype that holds their values with compact_int().
+
+Use corrected_data() to get data in the head-corrected biteplate coordinate
+system. If cachedir is not None, corrected data are cached there.'''
+    def __init__(self, basepath, speaker, sensors=None, with_ids=False,
+                 with_status=False, with_quats=False, dtype=np.float32,
+                 compact_status=False, cachedir=None, origin_sensor='OS',
+                 *args, **kwargs):
+        super(MarquetteSpeaker, self).__init__(*args, **kwargs)
+        self.basepath = basepath
+        self.speaker = speaker
+        if sensors is None:
+            sensors = [s for s in MARQUETTE_SENSORS if not s.startswith('UNK')]
+        self.sensors = sensors
+        self.with_ids = with_ids
+        self.with_status = with_status
+        self.compact_status = compact_status
+        self.with_quats = with_quats
+        self.dtype = dtype
+        self.cache = ColumnarCache(cachedir) if cachedir is not None else None
+        self.origin_sensor = origin_sensor  # Biteplate sensor at the origin.
+        self._palate = None
+        self._biteplate = None
+        self._rotation = None
+        self._bp_transform = None
+
+    @property
+    def spkpath(self):
+        return os.path.join(self.basepath, self.speaker)
+
+    @property
+    def coordcols(self):
+        '''Return the names of the coordinate columns that are read.'''
+        return [
+            '{}_{}'.format(s, d) for s in self.sensors for d in ['x', 'y', 'z']
+        ]
 
-    rotdf = pd.read_csv(
-        os.path.join(
-            spkpath, 'Calibration', 'Biteplate',
-            '{}_Biteplate_Rotation.txt'.format(speaker)
-        ),
-        sep='\t',
-        header=None
+    @property
+    def read_csv_kwargs(self):
+        '''Return keyword arguments for pd.read_csv() that select and convert
+the columns to read.'''
+        return self._read_csv_kwargs()
+
+    def _read_csv_kwargs(self, with_ref=False):
+        '''Return keyword arguments for pd.read_csv(). If with_ref is True the
+REF sensor position and quaternion columns are also read.'''
+        better_head = \
+            ['sec', 'measid', 'wavid'] + \
+            ['{}_{}'.format(s, c) for s in MARQUETTE_SENSORS for c in MARQUETTE_SUBCOLUMNS]
+        usecols = ['sec']
+        dtypes = {'sec': np.float64}
+        if self.with_ids is True:
+            usecols += ['measid', 'wavid']
+        for s in self.sensors:
+            subcols = ['x', 'y', 'z']
+            if self.with_quats is True:
+                subcols += ['q0', 'qx', 'qy', 'qz']
+            for c in subcols:
+                dtypes['{}_{}'.format(s, c)] = self.dtype
+            if self.with_status is True:
+                subcols.append('Status')
+            if self.with_ids is True:
+                subcols.append('ID')
+            usecols += ['{}_{}'.format(s, c) for c in subcols]
+        if with_ref is True:
+            for c in ['x', 'y', 'z', 'q0', 'qx', 'qy', 'qz']:
+                col = 'REF_{}'.format(c)
+                if col not in usecols:
+                    usecols.append(col)
+                    dtypes[col] = np.float64
+        return dict(
+            sep='\t',
+            header=None,            # These three parameters
+            skiprows=1,             # are used to override
+            names=better_head,      # the existing file header.
+            usecols=usecols,
+            dtype=dtypes
+        )
+
+    def data_fname(self, dataname):
+        '''Return the name of the speaker data file for dataname.'''
+        return os.path.join(
+            self.spkpath, 'Data', '{}_{}.tsv'.format(self.speaker, dataname)
+        )
+
+    def _read(self, fname, chunksize=None, **kwargs):
+        '''Read fname with pd.read_csv() and kwargs, which default to
+read_csv_kwargs, and compact the Status columns if compact_status is True. If
+chunksize is not None, return an iterator of DataFrames of chunksize rows.'''
+        kwargs = dict(self.read_csv_kwargs, **kwargs)
+        if chunksize is not None:
+            reader = pd.read_csv(fname, chunksize=chunksize, **kwargs)
+            if self.compact_status is not True:
+                return reader
+            return (self._compact_status(chunk) for chunk in reader)
+        return self._compact_status(pd.read_csv(fname, **kwargs))
+
+    def _compact_status(self, df):
+        '''Return df with its Status columns converted by compact_int() if
+compact_status is True.'''
+        if self.compact_status is True:
+            for c in df.columns:
+                if c.endswith('_Status'):
+                    df[c] = compact_int(df[c])
+        return df
+
+    def data(self, dataname, chunksize=None):
+        '''Read the speaker data file for dataname. If chunksize is not None,
+return an iterator of DataFrames of chunksize rows.'''
+        return self._read(self.data_fname(dataname), chunksize=chunksize)
+
+    def corrected_data(self, dataname):
+        '''Read the speaker data file for dataname and return it with the
+coordinates and quaternions of all sensors converted to the head-corrected
+biteplate coordinate system by head_correct().'''
+        fname = self.data_fname(dataname)
+        key = None
+        if self.cache is not None:
+            # The result also depends on the calibration files.
+            calstamps = []
+            for calfile in (self.biteplate_fname, self.rotation_fname):
+                st = os.stat(calfile)
+                calstamps.append((st.st_mtime_ns, st.st_size))
+            key = (
+                'corrected', tuple(self.sensors), self.with_ids, self.with_status,
+                self.compact_status, self.with_quats, np.dtype(self.dtype).str,
+                self.origin_sensor, tuple(calstamps)
+            )
+            df = self.cache.load(fname, key)
+            if df is not None:
+                return df
+        df = self.head_correct(
+            self._read(fname, **self._read_csv_kwargs(with_ref=True))
+        )
+        if self.cache is not None:
+            self.cache.save(fname, df, key)
+        return df
+
+    @property
+    def biteplate_transform(self):
+        '''Return the (origin, rotation) of the biteplate coordinate system.
+origin is the mean head-corrected position of origin_sensor in the biteplate
+recording, and rotation is the 3x3 biteplate rotation matrix.'''
+        if self._bp_transform is None:
+            bpdf = pd.read_csv(
+                self.biteplate_fname,
+                **self._read_csv_kwargs(with_ref=True)
+            )
+            cols = ['{}_{}'.format(self.origin_sensor, d) for d in 'xyz']
+            if cols[0] not in bpdf.columns:
+                bpdf = bpdf.join(pd.read_csv(
+                    self.biteplate_fname,
+                    **dict(self.read_csv_kwargs, usecols=cols, dtype=np.float64)
+                ))
+            refR = quat_to_rotmat(
+                bpdf[['REF_q0', 'REF_qx', 'REF_qy', 'REF_qz']].values
+            )
+            rel = np.einsum(
+                'nji,nj->ni',
+                refR,
+                bpdf[cols].values.astype(np.float64) - \
+                    bpdf[['REF_x', 'REF_y', 'REF_z']].values
+            )
+            self._bp_transform = (
+                np.nanmean(rel, axis=0),
+                self.rotation.values.astype(np.float64)
+            )
+        return self._bp_transform
+
+    def head_correct(self, df):
+        '''Return a copy of df, which must have REF position and quaternion
+columns, with the position of each sensor converted to the head-corrected
+biteplate coordinate system. The REF position is subtracted and the result
+rotated by the inverse of the REF orientation; then the biteplate origin is
+subtracted and the result rotated by the biteplate rotation. Quaternion
+columns of sensors are rotated likewise. All frames and sensors are
+transformed at once. Only the columns that data() returns are kept.'''
+        origin, bpR = self.biteplate_transform
+        refq = df[['REF_q0', 'REF_qx', 'REF_qy', 'REF_qz']].values
+        refq = refq.astype(np.float64)
+        refpos = df[['REF_x', 'REF_y', 'REF_z']].values.astype(np.float64)
+        sensors = [s for s in self.sensors if '{}_x'.format(s) in df.columns]
+        coordcols = ['{}_{}'.format(s, d) for s in sensors for d in 'xyz']
+        # Shape (frames, sensors, 3).
+        pos = df[coordcols].values.astype(np.float64).reshape(
+            len(df), len(sensors), 3
+        )
+        # Combined rotation R_bp . R_ref^T for each frame, then one batched
+        # product for all sensors.
+        R = np.einsum('ij,nkj->nik', bpR, quat_to_rotmat(refq))
+        pos = np.einsum('nij,nsj->nsi', R, pos - refpos[:, np.newaxis, :])
+        pos -= bpR.dot(origin)
+        outdf = df.copy()
+        outdf[coordcols] = pos.reshape(len(df), -1).astype(self.dtype)
+        qsensors = [s for s in sensors if '{}_q0'.format(s) in df.columns]
+        if len(qsensors) > 0:
+            qcols = [
+                '{}_{}'.format(s, c)
+                    for s in qsensors for c in ['q0', 'qx', 'qy', 'qz']
+            ]
+            q = df[qcols].values.astype(np.float64).reshape(
+                len(df), len(qsensors), 4
+            )
+            refconj = refq * np.array([1.0, -1.0, -1.0, -1.0])
+            q = quat_multiply(
+                quat_multiply(rotmat_to_quat(bpR), refconj)[:, np.newaxis, :], q
+            )
+            outdf[qcols] = q.reshape(len(df), -1).astype(self.dtype)
+        # Drop the REF columns that were read only for the correction.
+        usecols = self.read_csv_kwargs['usecols']
+        return outdf[[c for c in outdf.columns if c in usecols]]
+
+    @property
+    def palate(self):
+        '''The palate trace calibration data.'''
+        if self._palate is None:
+            self._palate = self._read(
+                os.path.join(
+                    self.spkpath, 'Calibration', 'Palate',
+                    '{}_palatetrace.tsv'.format(self.speaker)
+                )
+            )
+        return self._palate
+
+    @property
+    def biteplate_fname(self):
+        return os.path.join(
+            self.spkpath, 'Calibration', 'Biteplate',
+            '{}_Biteplate.tsv'.format(self.speaker)
+        )
+
+    @property
+    def rotation_fname(self):
+        return os.path.join(
+            self.spkpath, 'Calibration', 'Biteplate',
+            '{}_Biteplate_Rotation.txt'.format(self.speaker)
+        )
+
+    @property
+    def biteplate(self):
+        '''The biteplate calibration data.'''
+        if self._biteplate is None:
+            self._biteplate = self._read(self.biteplate_fname)
+        return self._biteplate
+
+    @property
+    def rotation(self):
+        '''The biteplate rotation matrix.'''
+        if self._rotation is None:
+            self._rotation = pd.read_csv(
+                self.rotation_fname,
+                sep='\t',
+                header=None
+            )
+        return self._rotation
+
+def read_marquette_speaker_data(basepath, speaker, dataname, sensors=MARQUETTE_SENSORS,
+                                with_ids=True, with_status=True, with_quats=True,
+                                dtype=np.float64):
+    '''Read Marquette EMA speaker data from a directory. Return speaker data,
+palate, and biteplate DataFrames and the biteplate rotation DataFrame. By
+default all columns are read; see MarquetteSpeaker for the options that select
+columns and dtype.'''
+    spk = MarquetteSpeaker(
+        basepath, speaker, sensors=sensors, with_ids=with_ids,
+        with_status=with_status, with_quats=with_quats, dtype=dtype
     )
-    
-#    return (with_quats(datadf, sensors), with_quats(paldf, sensors),
-#            with_quats(bpdf, sensors), rotdf)
-    return (datadf, paldf, bpdf, rotdf)
+    return (spk.data(dataname), spk.palate, spk.biteplate, spk.rotation)
 
+def iter_marquette_speaker_data(basepath, speaker, dataname, chunksize=100000,
+                                sensors=MARQUETTE_SENSORS, with_ids=True,
+                                with_status=True, with_quats=True,
+                                dtype=np.float64):
+    '''Yield Marquette EMA speaker data as DataFrames of chunksize rows, with
+the columns of the data returned by read_marquette_speaker_data() plus
+<coordinate>_vel columns calculated across chunk boundaries by
+iter_with_vel().'''
+    spk = MarquetteSpeaker(
+        basepath, speaker, sensors=sensors, with_ids=with_ids,
+        with_status=with_status, with_quats=with_quats, dtype=dtype
+    )
+    return iter_with_vel(spk.data(dataname, chunksize=chunksize), spk.coordcols)
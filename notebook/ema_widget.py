@@ -1,3 +1,6 @@
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import pyqtgraph as pg
 from pyqtgraph.Qt import QtGui, QtCore
 #from ema import read_ecog_speaker_audio, read_ecog_speaker_data, \
@@ -5,11 +8,21 @@ from pyqtgraph.Qt import QtGui, QtCore
 from ema import EmaEcogDataLoader
 
 class DataLoaderWidget(pg.GraphicsLayoutWidget):
-    '''A widget for selecting EMA-ECOG files to load.'''
+    '''A widget for selecting EMA-ECOG files to load. Pass data_loader to
+load other data with the same interface as EmaEcogDataLoader, e.g. an
+xray.XrayDataLoader.'''
     #emasig_speaker_selected = QtCore.pyqtSignal(str)
     data_loaded = QtCore.pyqtSignal()
     selected_elements_changed = QtCore.pyqtSignal()
     xyz_map_changed = QtCore.pyqtSignal()
+    load_progress = QtCore.pyqtSignal(int, int)  # Number of tasks done, total
+    load_failed = QtCore.pyqtSignal(object)      # The exception raised
+    # Emitted with the stack, elements and reps of load_rep_stack().
+    rep_stack_loaded = QtCore.pyqtSignal(object, object, object)
+    # Emitted from worker threads with load id, task name, result, exception.
+    _load_task_done = QtCore.pyqtSignal(int, str, object, object)
+    # Emitted from worker threads with load id, number of steps done, total.
+    _load_task_progress = QtCore.pyqtSignal(int, int, int)
  
     @property
     def selected_speaker(self):
@@ -37,7 +50,10 @@ class DataLoaderWidget(pg.GraphicsLayoutWidget):
 
     @property
     def xyz_map(self):
-        return self.xyz_cb.currentText()
+        try:
+            return self.xyz_cb.currentText()
+        except AttributeError:  # No data loaded yet.
+            return 'xyz'
 
     @property
     def selected_elements(self):
@@ -69,10 +85,12 @@ as values.'''
     def selected_pos_vel_dim(self):
         return self.pos_vel_dim_cb.currentText()
 
-    def __init__(self, datadir, *args, **kwargs):
+    def __init__(self, datadir, data_loader=None, *args, **kwargs):
         super(DataLoaderWidget, self).__init__(*args, **kwargs)
         self.setStyleSheet('background-color:white;')
-        self.data_loader = EmaEcogDataLoader(datadir)
+        if data_loader is None:
+            data_loader = EmaEcogDataLoader(datadir)
+        self.data_loader = data_loader
         layout = QtGui.QVBoxLayout()
 
         self.spkr = QtGui.QComboBox()
@@ -88,21 +106,39 @@ as values.'''
         self.add_speakers()
 
         self.load_button = QtGui.QPushButton('Load utt')
+        self.cancel_button = QtGui.QPushButton('Cancel')
+        self.cancel_button.setEnabled(False)
+        self.load_progressbar = QtGui.QProgressBar()
+
+        # Audio, articulation and palate data are loaded concurrently.
+        self.executor = ThreadPoolExecutor(max_workers=3)
+        self._load_id = 0         # Incremented to cancel current load.
+        self._load_futures = []
+        self._load_results = {}
+        self._load_ntasks = 0
+        self._load_selection = None
+        self.prefetch_next_utt = False  # Also prefetch the next utterance.
+        self._load_task_done.connect(self._handle_load_task_done)
+        self._load_task_progress.connect(self._handle_load_task_progress)
 
         self.spkr.currentTextChanged.connect(self.speaker_selected)
         self.utt.currentTextChanged.connect(self.utterance_selected)
         self.load_button.clicked.connect(self.load_data)
+        self.cancel_button.clicked.connect(self.cancel_load)
 
         layout.addWidget(self.spkr)
         layout.addWidget(self.utt)
         layout.addWidget(self.rep)
         layout.addWidget(self.channel)
         layout.addWidget(self.load_button)
+        layout.addWidget(self.cancel_button)
+        layout.addWidget(self.load_progressbar)
         layout.addWidget(self.el_sel)
         self.setLayout(layout)
 
-    def add_elements(self, checked=[]):
-        '''Add element checkboxes and set as checked if in checked.'''
+    def add_elements(self, checked=[], xyz_map='xyz'):
+        '''Add element checkboxes and set as checked if in checked. Set the
+xyz_map combobox to xyz_map.'''
         for idx, el in enumerate(self.elements):
             elbox = QtGui.QCheckBox(el)
             elbox.setChecked(el in checked)
@@ -132,6 +168,7 @@ as values.'''
         xyzcb.addItem('yzx')
         xyzcb.addItem('zxy')
         xyzcb.addItem('zyx')
+        xyzcb.setCurrentText(xyz_map)
         xyzcb.currentIndexChanged.connect(self.handle_xyz_map_select)
         self.el_sel.layout().addWidget(xyzcb)
         self.xyz_cb = xyzcb
@@ -174,13 +211,134 @@ selection.'''
         )
 
     def load_data(self):
-        was_selected = self.selected_elements
-        self.clear_elements()
-        self.rate, self.au = self.get_audio()
-        self.datadf = self.get_speaker_utt()
-        self.add_elements(was_selected)
-        self.landmarkdf = self.get_palate_trace()
-        self.data_loaded.emit()
+        '''Start loading audio, articulation and palate data for the current
+selections in worker threads. The utterance is loaded with the data loader's
+load_utt(), so a prefetch of it that is still running is waited for rather
+than repeated. When all data are loaded they are stored in the widget on the
+GUI thread and data_loaded is emitted. A load that is already in progress is
+cancelled.'''
+        self.cancel_load()
+        load_id = self._load_id
+        spkr = self.selected_speaker
+        utt = self.selected_utterance
+        rep = self.selected_rep
+        channel = int(self.selected_channel)
+        xyz_map = self.xyz_map
+        tasks = {
+# TODO: don't hardcode trange
+            'landmarkdf': partial(
+                self.data_loader.get_palate_trace,
+                spkr, trange=[1,12], xdim=xyz_map[0], ydim=xyz_map[1]
+            ),
+            # load_utt() returns the utterance from the utt_cache, or waits
+            # for it if it is being prefetched, or else loads it.
+            'utt': partial(self.data_loader.load_utt, spkr, utt, rep, channel),
+        }
+        self._load_selection = (spkr, utt, rep, channel)
+        self._load_xyz_map = xyz_map
+        self._start_load(load_id, tasks)
+
+    def load_rep_stack(self, elements=None):
+        '''Start loading all repetitions of the current utterance in a worker
+thread with the data loader's get_rep_stack(), which time-normalizes them.
+Progress is shown per rep, and rep_stack_loaded is emitted with the stack,
+elements and reps on the GUI thread when they are loaded. Like load_data(),
+the load can be cancelled with cancel_load(). Return False if the data loader
+has no get_rep_stack(), i.e. the data have no repetitions, or no utterance is
+selected.'''
+        get_rep_stack = getattr(self.data_loader, 'get_rep_stack', None)
+        if get_rep_stack is None or self.selected_utterance == '':
+            return False
+        self.cancel_load()
+        load_id = self._load_id
+        task = partial(
+            get_rep_stack,
+            self.selected_speaker,
+            self.selected_utterance,
+            elements=elements,
+            progress=partial(self._load_task_progress.emit, load_id),
+            is_cancelled=lambda: load_id != self._load_id
+        )
+        self._start_load(load_id, {'rep_stack': task})
+        return True
+
+    def _start_load(self, load_id, tasks):
+        '''Submit the tasks of a load, a dict of task names and callables, to
+the worker threads.'''
+        self._load_ntasks = len(tasks)
+        self.load_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self.load_progressbar.setRange(0, self._load_ntasks)
+        self.load_progressbar.setValue(len(self._load_results))
+        for name, task in tasks.items():
+            fut = self.executor.submit(task)
+            fut.add_done_callback(partial(self._load_task_finished, load_id, name))
+            self._load_futures.append(fut)
+
+    def cancel_load(self):
+        '''Cancel the load in progress, if any. Tasks that are already
+running can't be interrupted, but their results are discarded.'''
+        self._load_id += 1
+        for fut in self._load_futures:
+            fut.cancel()
+        self._load_futures = []
+        self._load_results = {}
+        self.load_progressbar.reset()
+        self.load_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+
+    def _load_task_finished(self, load_id, name, fut):
+        '''Pass the result of a finished load task to the GUI thread. This
+is called in the worker thread.'''
+        if fut.cancelled():
+            return
+        exc = fut.exception()
+        result = fut.result() if exc is None else None
+        self._load_task_done.emit(load_id, name, result, exc)
+
+    def _handle_load_task_progress(self, load_id, ndone, ntotal):
+        '''Show the progress of a load task that reports its steps.'''
+        if load_id != self._load_id:  # The load was cancelled.
+            return
+        self.load_progressbar.setRange(0, ntotal)
+        self.load_progressbar.setValue(ndone)
+        self.load_progress.emit(ndone, ntotal)
+
+    def _handle_load_task_done(self, load_id, name, result, exc):
+        '''Store the result of a load task, and finish the load when all of
+its tasks are done.'''
+        if load_id != self._load_id:  # The load was cancelled.
+            return
+        if exc is not None:
+            self.cancel_load()
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+            self.load_failed.emit(exc)
+            return
+        self._load_results[name] = result
+        ndone = len(self._load_results)
+        if name != 'rep_stack':  # Its progress is shown per rep.
+            self.load_progressbar.setValue(ndone)
+            self.load_progress.emit(ndone, self._load_ntasks)
+        if ndone == self._load_ntasks:
+            results = self._load_results
+            self._load_futures = []
+            self._load_results = {}
+            self.load_button.setEnabled(True)
+            self.cancel_button.setEnabled(False)
+            if 'rep_stack' in results:
+                self.rep_stack_loaded.emit(*results['rep_stack'])
+                return
+            was_selected = self.selected_elements
+            self.clear_elements()
+            self.rate, self.au, self.datadf, self.envelope = results['utt']
+            self.add_elements(was_selected, self._load_xyz_map)
+            self.landmarkdf = results['landmarkdf']
+            self.data_loaded.emit()
+            # Prefetch the neighbors of this utterance, since we usually step
+            # through the reps one after another.
+            self.data_loader.prefetch_neighbors(
+                *self._load_selection, next_utt=self.prefetch_next_utt
+            )
 
     def add_speakers(self, blockSignals=True):
         '''Add speakers to the speaker combobox.'''
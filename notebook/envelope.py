@@ -0,0 +1,126 @@
+import os, zipfile
+import numpy as np
+import datacache   # Not from-imported, since datacache imports this module.
+
+def padded_view(viewbox, minpixels=100):
+    '''Return the x range of viewbox padded by one view width on either side,
+so that panning doesn't reveal undrawn data before the next update, the
+unpadded x range, and the width of viewbox in pixels, at least minpixels.'''
+    x0, x1 = viewbox.viewRange()[0]
+    pad = x1 - x0
+    npixels = max(int(viewbox.width()), minpixels)
+    return ((x0 - pad, x1 + pad), (x0, x1), npixels)
+
+class EnvelopePyramid():
+    '''A multi-resolution min/max envelope of a 1-d signal.
+
+Level 0 is the signal itself. Each higher level holds the minimum and maximum
+of consecutive blocks of the signal, with blocks factor times longer than
+those of the level below. Levels are added until a level has fewer than
+minblocks blocks. Use segment() to get the data to draw for a range of
+samples at the resolution that suits the number of points that can be
+displayed. If ignore_nan is True, NaN values are ignored in the minimum and
+maximum of blocks, so that a block is NaN only if all of its values are.'''
+    def __init__(self, data, factor=4, minblocks=256, levels=None,
+                 ignore_nan=False, *args, **kwargs):
+        super(EnvelopePyramid, self).__init__(*args, **kwargs)
+        self.data = data
+        self.factor = factor
+        self.minblocks = minblocks
+        self.ignore_nan = ignore_nan
+        if levels is None:
+            levels = self._build_levels()
+        # List of (blocksize, mins, maxs) tuples, finest first.
+        self.levels = levels
+
+    def _build_levels(self):
+        '''Return a list of (blocksize, mins, maxs) tuples.'''
+        levels = []
+        mins = maxs = self.data
+        blocksize = 1
+        while len(mins) >= self.minblocks * self.factor:
+            starts = np.arange(0, len(mins), self.factor)
+            if self.ignore_nan is True:
+                mins = np.fmin.reduceat(mins, starts)
+                maxs = np.fmax.reduceat(maxs, starts)
+            else:
+                mins = np.minimum.reduceat(mins, starts)
+                maxs = np.maximum.reduceat(maxs, starts)
+            blocksize *= self.factor
+            levels.append((blocksize, mins, maxs))
+        return levels
+
+    def segment(self, i0, i1, maxpoints):
+        '''Return sample indexes and values for drawing samples i0 to i1 with
+no more than about maxpoints points. If the samples must be decimated, each
+block is represented by its minimum and maximum at the index of the block's
+first sample.'''
+        i0 = max(int(i0), 0)
+        i1 = min(int(i1), len(self.data))
+        if i1 - i0 <= maxpoints or len(self.levels) == 0:
+            return (np.arange(i0, i1), self.data[i0:i1])
+        for blocksize, mins, maxs in self.levels:
+            if (i1 - i0) / blocksize <= maxpoints / 2:
+                break
+        b0 = i0 // blocksize
+        b1 = -(-i1 // blocksize)   # Ceiling division.
+        idx = np.repeat(np.arange(b0, b1) * blocksize, 2)
+        vals = np.empty(len(idx), dtype=mins.dtype)
+        vals[0::2] = mins[b0:b1]
+        vals[1::2] = maxs[b0:b1]
+        return (idx, vals)
+
+    @staticmethod
+    def _source_stamp(srcfile):
+        '''Return the modification time and size of srcfile, or -1s if
+srcfile is None.'''
+        if srcfile is None:
+            return [-1, -1]
+        st = os.stat(srcfile)
+        return [st.st_mtime_ns, st.st_size]
+
+    def save(self, fname, srcfile=None):
+        '''Save the envelope levels to an .npz file with
+datacache.atomic_write(). If srcfile, the file that data were read from, is
+given, its modification time and size are saved too, so that load() can tell
+when the envelope is stale. Return True on success, False if the file could
+not be written.'''
+        try:
+            stamp = self._source_stamp(srcfile)
+        except OSError:
+            return False
+        arrays = {
+            'params': np.array(
+                [len(self.data), self.factor, self.minblocks] + stamp,
+                dtype=np.int64
+            )
+        }
+        for lidx, (blocksize, mins, maxs) in enumerate(self.levels):
+            arrays['mins{}'.format(lidx)] = mins
+            arrays['maxs{}'.format(lidx)] = maxs
+        return datacache.atomic_write(fname, lambda fh: np.savez(fh, **arrays))
+
+    @classmethod
+    def load(cls, fname, data, factor=4, minblocks=256, srcfile=None):
+        '''Load the envelope levels of data from an .npz file written by
+save(). Return None if the file does not exist or was created with
+different data length or parameters, or, if srcfile is given, if srcfile has
+been modified since the envelope was saved.'''
+        try:
+            params = [len(data), factor, minblocks] + cls._source_stamp(srcfile)
+            with np.load(fname) as npz:
+                if list(npz['params']) != params:
+                    return None
+                levels = []
+                blocksize = 1
+                while 'mins{}'.format(len(levels)) in npz:
+                    blocksize *= factor
+                    lidx = len(levels)
+                    levels.append((
+                        blocksize,
+                        npz['mins{}'.format(lidx)],
+                        npz['maxs{}'.format(lidx)]
+                    ))
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        return cls(data, factor=factor, minblocks=minblocks, levels=levels)
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+'''Export per-token kinematic features for a whole data directory.
+
+Usage: export.py [--layout {ema,marquette,xray}] [--workers N] datadir outfile
+
+Each token (speaker utterance/repetition) is read in a pool of worker
+processes, and position, velocity and extrema features are computed for
+every coordinate column. Per-token results are saved in the directory
+<outfile>.parts as they are computed, so an interrupted export resumes where
+it stopped when it is run again. When all tokens are done the results are
+written to outfile as one long-format table, in a format determined by the
+extension of outfile: .parquet, .feather, .csv or .pkl.
+'''
+
+import os, re, sys, hashlib, argparse, warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from datacache import atomic_write
+from deriv import Derivatives
+
+_reader = None   # Per-process reader, set by _init_worker().
+
+def find_tokens(layout, datadir):
+    '''Return a list of (speaker, utterance, rep) tokens in datadir. rep is
+'' for layouts that have no repetitions.'''
+    tokens = []
+    if layout == 'ema':
+        from ema import EmaEcogDataLoader
+        loader = EmaEcogDataLoader(datadir, lazy=False)
+        for spkr in loader.get_speaker_list():
+            for utt in loader.get_utterance_list_for_speaker(spkr):
+                for rep in loader.get_rep_list_for_speaker_utterance(spkr, utt):
+                    tokens.append((spkr, utt, rep))
+    elif layout == 'marquette':
+        for spkr in sorted(os.listdir(datadir)):
+            ddir = os.path.join(datadir, spkr, 'Data')
+            if not os.path.isdir(ddir):
+                continue
+            tsvre = re.compile(r'^{}_(.+)\.tsv$'.format(re.escape(spkr)))
+            for f in sorted(os.listdir(ddir)):
+                m = tsvre.search(f)
+                if m:
+                    tokens.append((spkr, m.group(1), ''))
+    elif layout == 'xray':
+        from xray import walk_xray_datadir
+        for spkr, utts in sorted(walk_xray_datadir(datadir).items()):
+            for utt in sorted(utts):
+                tokens.append((spkr, utt, ''))
+    else:
+        raise ValueError('Unrecognized layout {}.'.format(layout))
+    return tokens
+
+def _init_worker(layout, datadir):
+    '''Set up the reader used by process_token() in a worker process.'''
+    global _reader
+    if layout == 'ema':
+        from ema import EmaEcogDataLoader
+        loader = EmaEcogDataLoader(datadir)
+        _reader = lambda spkr, utt, rep: loader.get_speaker_utt(spkr, utt, rep)
+    elif layout == 'marquette':
+        from ema import MarquetteSpeaker
+        _reader = lambda spkr, utt, rep: \
+            MarquetteSpeaker(datadir, spkr).data(utt)
+    elif layout == 'xray':
+        from xray import XrayDataLoader
+        loader = XrayDataLoader(datadir)   # Knows where speaker dirs are.
+        _reader = lambda spkr, utt, rep: loader.get_speaker_utt(spkr, utt)
+
+def token_features(df):
+    '''Return a DataFrame of features of the coordinate columns of df, one
+row per column. Velocities are in units per second, calculated with the
+default Derivatives filter.'''
+    coordcols = [c for c in df.columns if c[-2:] in ['_x', '_y', '_z']]
+    sec = df.sec.values
+    pos = df[coordcols].values.astype(float)
+    vel = Derivatives(df).velocity(coordcols)
+    feats = {
+        'column': coordcols,
+        'element': [c[:-2] for c in coordcols],
+        'dim': [c[-1] for c in coordcols],
+        'nframes': np.sum(~np.isnan(pos), axis=0),
+        'dur': np.repeat(sec[-1] - sec[0] if len(sec) > 0 else np.nan, len(coordcols)),
+    }
+    for name, a in (('pos', pos), ('vel', vel)):
+        nans = np.isnan(a)
+        allnan = np.all(nans, axis=0)
+        imin = np.argmin(np.where(nans, np.inf, a), axis=0)
+        imax = np.argmax(np.where(nans, -np.inf, a), axis=0)
+        with warnings.catch_warnings():  # All-NaN columns are expected.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            feats['{}_mean'.format(name)] = np.nanmean(a, axis=0)
+            feats['{}_sd'.format(name)] = np.nanstd(a, axis=0)
+            feats['{}_min'.format(name)] = np.nanmin(a, axis=0)
+            feats['{}_max'.format(name)] = np.nanmax(a, axis=0)
+        feats['{}_tmin'.format(name)] = np.where(allnan, np.nan, sec[imin])
+        feats['{}_tmax'.format(name)] = np.where(allnan, np.nan, sec[imax])
+    return pd.DataFrame(feats)
+
+def process_token(token, partsdir):
+    '''Compute features for token and save them in partsdir. Return token.'''
+    spkr, utt, rep = token
+    feats = token_features(_reader(spkr, utt, rep))
+    feats.insert(0, 'rep', rep)
+    feats.insert(0, 'utterance', utt)
+    feats.insert(0, 'speaker', spkr)
+    fname = part_fname(partsdir, token)
+    # Written atomically, so only complete parts are seen on resume.
+    if not atomic_write(fname, feats.to_pickle):
+        raise OSError('Could not write {}.'.format(fname))
+    return token
+
+def part_fname(partsdir, token):
+    '''Return the name of the file that holds the features of token.'''
+    h = hashlib.sha1(repr(token).encode('utf-8')).hexdigest()
+    return os.path.join(partsdir, '{}.pkl'.format(h))
+
+def write_dataset(df, outfile):
+    '''Write df to outfile in the format given by its extension.'''
+    ext = os.path.splitext(outfile)[1].lower()
+    if ext == '.parquet':
+        df.to_parquet(outfile, index=False)
+    elif ext == '.feather':
+        df.to_feather(outfile)
+    elif ext == '.csv':
+        df.to_csv(outfile, index=False)
+    elif ext == '.pkl':
+        df.to_pickle(outfile)
+    else:
+        raise ValueError('Unrecognized output format {}.'.format(ext))
+
+def export(layout, datadir, outfile, workers=None, verbose=True):
+    '''Export features of all tokens in datadir to outfile. Return the
+number of tokens that could not be processed.'''
+    partsdir = outfile + '.parts'
+    os.makedirs(partsdir, exist_ok=True)
+    tokens = find_tokens(layout, datadir)
+    todo = [t for t in tokens if not os.path.exists(part_fname(partsdir, t))]
+    if verbose is True:
+        print('{} tokens, {} already done'.format(len(tokens), len(tokens) - len(todo)))
+    nfailed = 0
+    with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(layout, datadir)
+        ) as executor:
+        futures = {executor.submit(process_token, t, partsdir): t for t in todo}
+        for ndone, fut in enumerate(as_completed(futures), 1):
+            try:
+                fut.result()
+            except Exception as e:
+                nfailed += 1
+                sys.stderr.write('{}: {}\n'.format(futures[fut], e))
+            if verbose is True:
+                print('{}/{} {}'.format(ndone, len(todo), futures[fut]))
+    if nfailed > 0:
+        return nfailed
+    parts = [pd.read_pickle(part_fname(partsdir, t)) for t in tokens]
+    if len(parts) > 0:
+        write_dataset(pd.concat(parts, ignore_index=True), outfile)
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Export per-token kinematic features for a data directory.'
+    )
+    parser.add_argument(
+        '--layout', choices=['ema', 'marquette', 'xray'], default='ema',
+        help='layout of datadir (default: ema)'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)'
+    )
+    parser.add_argument('datadir')
+    parser.add_argument('outfile')
+    args = parser.parse_args()
+    nfailed = export(args.layout, args.datadir, args.outfile, workers=args.workers)
+    if nfailed > 0:
+        sys.stderr.write(
+            '{} tokens failed; run again to retry them and write {}.\n'.format(
+                nfailed, args.outfile
+            )
+        )
+        sys.exit(1)
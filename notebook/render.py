@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+'''Render an articulation movie without a display.
+
+Usage: render.py [options] datadir speaker utterance outfile
+
+The frame, trace, position and velocity plots of an ArticuWidget are rendered
+offscreen (QT_QPA_PLATFORM=offscreen) for each video frame from --start to
+--end, in blocks of frames that are rendered in parallel in a pool of worker
+processes. If outfile has a video extension (.mp4, .mov, .mkv, .avi, .webm)
+the frames are encoded with ffmpeg, with the audio of the same time range
+muxed in. Otherwise outfile is a directory that the frames are written to as
+frame_000000.png, frame_000001.png, ..., along with the audio as audio.wav.
+'''
+
+import os, shutil, argparse, tempfile, subprocess, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import scipy.io.wavfile
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+VIDEO_EXTS = ['.mp4', '.mov', '.mkv', '.avi', '.webm']
+FRAME_FMT = 'frame_{:06d}.png'
+
+_app = None      # Per-process QApplication, set by _init_worker().
+_widget = None   # Per-process ArticuWidget, set by _init_worker().
+_t1 = None       # Start time of the rendered range.
+
+def make_loader(layout, datadir):
+    '''Return a data loader for datadir.'''
+    if layout == 'ema':
+        from ema import EmaEcogDataLoader
+        return EmaEcogDataLoader(datadir)
+    elif layout == 'xray':
+        from xray import XrayDataLoader
+        return XrayDataLoader(datadir)
+    raise ValueError('Unrecognized layout {}.'.format(layout))
+
+def frame_times(t1, t2, fps):
+    '''Return the media times of the video frames from t1 to t2.'''
+    return t1 + np.arange(int(np.floor((t2 - t1) * fps)) + 1) / fps
+
+def _init_worker(layout, datadir, speaker, utterance, rep, t1, t2, elements,
+                 pos_vel_elements, xyz, size):
+    '''Create the ArticuWidget used by render_frames() in a worker process.'''
+    global _app, _widget, _t1
+    from pyqtgraph.Qt import QtGui
+    import pyqtgraph as pg
+    from artic import ArticuWidget, EMA_LINES, EMA_BRUSHES
+    _app = QtGui.QApplication.instance() or QtGui.QApplication([])
+    pg.setConfigOptions(antialias=True)
+    loader = make_loader(layout, datadir)
+    df = loader.get_speaker_utt(speaker, utterance, rep)
+    try:
+# TODO: don't hardcode trange
+        landmarkdf = loader.get_palate_trace(
+            speaker, trange=[1,12], xdim=xyz[0], ydim=xyz[1]
+        )
+    except (OSError, KeyError):  # No palate data
+        landmarkdf = None
+    _widget = ArticuWidget()
+    _widget.resize(*size)
+    _widget.show()
+    _widget.init_dataplots(
+        df, landmarkdf, lines=EMA_LINES, brushes=EMA_BRUSHES, xyz=xyz
+    )
+    if elements is None:
+        elements = [c[:-2] for c in df.columns if c.endswith('_x')]
+    _widget.elements = elements
+    _widget.pos_vel_elements = pos_vel_elements
+    _widget.tplot(t1, t2)
+    _t1 = t1
+    _app.processEvents()
+
+def render_frames(block, outdir):
+    '''Render the (index, time) frames in block to PNG files in outdir.
+Return the number of frames rendered.'''
+    for idx, t in block:
+        _widget.update_tplot(_t1, t)
+        img = _widget.grab().toImage()
+        if not img.save(os.path.join(outdir, FRAME_FMT.format(idx))):
+            raise OSError('Could not write frame {}.'.format(idx))
+    return len(block)
+
+def write_audio(loader, speaker, utterance, rep, channel, t1, t2, fname):
+    '''Write the audio of a speaker utterance from t1 to t2 to fname.'''
+    rate, au = loader.get_audio(speaker, utterance, rep, channel)
+    s1 = max(int(np.round(t1 * rate)), 0)
+    s2 = min(int(np.round(t2 * rate)), len(au))
+    scipy.io.wavfile.write(fname, rate, np.ascontiguousarray(au[s1:s2]))
+
+def encode(outdir, fps, audiofile, outfile):
+    '''Encode the frames in outdir and audiofile to outfile with ffmpeg.'''
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError('ffmpeg is required to write {}.'.format(outfile))
+    cmd = [
+        ffmpeg, '-y', '-loglevel', 'error',
+        '-framerate', str(fps),
+        '-i', os.path.join(outdir, FRAME_FMT.replace('{:06d}', '%06d')),
+        '-i', audiofile,
+        '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+        # libx264 with yuv420p requires even dimensions.
+        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+        '-c:a', 'aac',
+        '-shortest',
+        outfile
+    ]
+    subprocess.run(cmd, check=True)
+
+def render(layout, datadir, speaker, utterance, outfile, rep=None, channel=0,
+           t1=None, t2=None, fps=30, size=(800, 600), elements=None,
+           pos_vel_elements=[], xyz='xyz', workers=None, blocksize=50,
+           verbose=True):
+    '''Render a speaker utterance from media time t1 to t2 to outfile. By
+default the whole utterance is rendered. See the module docstring.'''
+    loader = make_loader(layout, datadir)
+    sec = loader.get_speaker_utt(speaker, utterance, rep).sec.values
+    if t1 is None:
+        t1 = sec[0]
+    if t2 is None:
+        t2 = sec[-1]
+    times = frame_times(t1, t2, fps)
+    frames = list(enumerate(times))
+    blocks = [
+        frames[idx:idx + blocksize] for idx in range(0, len(frames), blocksize)
+    ]
+    is_video = os.path.splitext(outfile)[1].lower() in VIDEO_EXTS
+    if is_video:
+        outdir = tempfile.mkdtemp(
+            prefix='render_', dir=os.path.dirname(os.path.abspath(outfile))
+        )
+    else:
+        outdir = outfile
+        os.makedirs(outdir, exist_ok=True)
+    try:
+        audiofile = os.path.join(outdir, 'audio.wav')
+        write_audio(loader, speaker, utterance, rep, channel, t1, t2, audiofile)
+        # Qt must not be initialized before the worker processes are started,
+        # so they are spawned rather than forked.
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(
+                    layout, datadir, speaker, utterance, rep, t1, t2, elements,
+                    pos_vel_elements, xyz, size
+                )
+            ) as executor:
+            ndone = 0
+            for n in executor.map(render_frames, blocks, [outdir] * len(blocks)):
+                ndone += n
+                if verbose is True:
+                    print('{}/{} frames'.format(ndone, len(frames)))
+        if is_video:
+            encode(outdir, fps, audiofile, outfile)
+    finally:
+        if is_video:
+            shutil.rmtree(outdir, ignore_errors=True)
+    return len(frames)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Render an articulation movie without a display.'
+    )
+    parser.add_argument(
+        '--layout', choices=['ema', 'xray'], default='ema',
+        help='layout of datadir (default: ema)'
+    )
+    parser.add_argument('--rep', default=None, help='repetition of utterance')
+    parser.add_argument(
+        '--channel', type=int, default=0, help='audio channel (default: 0)'
+    )
+    parser.add_argument(
+        '--start', type=float, default=None,
+        help='start time in seconds (default: start of utterance)'
+    )
+    parser.add_argument(
+        '--end', type=float, default=None,
+        help='end time in seconds (default: end of utterance)'
+    )
+    parser.add_argument(
+        '--fps', type=float, default=30, help='frames per second (default: 30)'
+    )
+    parser.add_argument(
+        '--size', default='800x600', help='frame size WxH (default: 800x600)'
+    )
+    parser.add_argument(
+        '--elements', default=None,
+        help='comma-separated elements to plot (default: all)'
+    )
+    parser.add_argument(
+        '--pos-vel', default='',
+        help='comma-separated elements of position and velocity plots'
+    )
+    parser.add_argument(
+        '--xyz', default='xyz', help='mapping of displayed dims to data dims'
+    )
+    parser.add_argument(
+        '--workers', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)'
+    )
+    parser.add_argument('datadir')
+    parser.add_argument('speaker')
+    parser.add_argument('utterance')
+    parser.add_argument('outfile')
+    args = parser.parse_args()
+    try:
+        size = tuple(int(v) for v in args.size.split('x'))
+        assert(len(size) == 2)
+    except (ValueError, AssertionError):
+        parser.error('--size must be WxH, e.g. 800x600')
+    render(
+        args.layout, args.datadir, args.speaker, args.utterance, args.outfile,
+        rep=args.rep,
+        channel=args.channel,
+        t1=args.start,
+        t2=args.end,
+        fps=args.fps,
+        size=size,
+        elements=args.elements.split(',') if args.elements else None,
+        pos_vel_elements=[e for e in args.pos_vel.split(',') if e != ''],
+        xyz=args.xyz,
+        workers=args.workers
+    )
@@ -1,62 +1,279 @@
-import os, re
+import os, re, threading, json
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import scipy.io.wavfile
+from datacache import ColumnarCache, UtteranceCache, atomic_write, default_cachedir
 
 # These are functions that are specific to the xray data and go in a separate repo.
-def walk_xray_datadir(datadir):
+def walk_xray_datadir(datadir, cachedir=None, use_cache=True,
+                      cache_in_datadir=False, workers=8, with_paths=False):
     '''Walk datadir and return a dict in which the keys are speakers and the
-values are lists of their utterances.'''
-    speakers = {}
-    jwre = re.compile(r'(JW\d+)$')
-    for root, dirnames, filenames in os.walk(datadir):
-        m = jwre.search(root)
-        if m:
-            spkr = m.groups()[0]
-            utterances = [
-                f.replace('.txy', '') for f in filenames if f.endswith('.txy')
-            ]
-            speakers[spkr] = utterances
+values are lists of their utterances. Speaker directories can be at any depth
+below datadir. If with_paths is True, also return a dict that maps speakers to
+their directories.
+
+Speaker directories are found with os.scandir() and listed in up to workers
+parallel threads. Speaker directories are not searched for further speaker
+directories. If use_cache is True the result is also stored in a manifest
+file in cachedir (by default datacache.default_cachedir(datadir,
+cache_in_datadir)), along with the
+modification time of each speaker directory, and only speaker directories
+that have changed since the manifest was written are listed again.'''
+    if cachedir is None:
+        cachedir = default_cachedir(datadir, cache_in_datadir)
+    manifest_fname = os.path.join(cachedir, 'xray_manifest.json') \
+        if use_cache is True else None
+    manifest = _read_xray_manifest(manifest_fname, datadir)
+    jwre = re.compile(r'^JW\d+$')
+    spkrdirs = {}
+    todo = [datadir]
+    while len(todo) > 0:
+        with os.scandir(todo.pop()) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                if jwre.search(entry.name):
+                    spkrdirs[entry.name] = (entry.path, entry.stat().st_mtime_ns)
+                elif entry.path != cachedir:
+                    todo.append(entry.path)
+    newmanifest = {}
+    toscan = []
+    for spkr, (path, mtime) in spkrdirs.items():
+        entry = manifest.get(spkr)
+        if entry is not None and entry['path'] == path and entry['mtime'] == mtime:
+            newmanifest[spkr] = entry
+        else:
+            newmanifest[spkr] = {'path': path, 'mtime': mtime}
+            toscan.append(spkr)
+    if len(toscan) > 0:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            scanned = executor.map(
+                _scan_xray_speaker, [newmanifest[spkr]['path'] for spkr in toscan]
+            )
+            for spkr, utterances in zip(toscan, scanned):
+                newmanifest[spkr]['utterances'] = utterances
+    if manifest_fname is not None and newmanifest != manifest:
+        _write_xray_manifest(manifest_fname, datadir, newmanifest)
+    speakers = {spkr: list(v['utterances']) for spkr, v in newmanifest.items()}
+    if with_paths is True:
+        return (speakers, {spkr: v['path'] for spkr, v in newmanifest.items()})
     return speakers
 
-def load_xray_files(datadir, speaker, utterance, badval=1000000):
+def _scan_xray_speaker(path):
+    '''Return a list of the utterances in a speaker directory.'''
+    with os.scandir(path) as it:
+        return [
+            e.name[:-4] for e in it if e.name.endswith('.txy') and e.is_file()
+        ]
+
+def _read_xray_manifest(fname, datadir):
+    '''Return the speakers in the manifest of datadir, or an empty dict if
+there is none.'''
+    try:
+        with open(fname, 'r') as fh:
+            manifest = json.load(fh)
+        assert(manifest['datadir'] == os.path.abspath(datadir))
+        return manifest['speakers']
+    except (TypeError, OSError, ValueError, KeyError, AssertionError):
+        return {}
+
+def _write_xray_manifest(fname, datadir, speakers):
+    '''Write the manifest of datadir with datacache.atomic_write().'''
+    return atomic_write(
+        fname,
+        lambda fh: json.dump(
+            {'datadir': os.path.abspath(datadir), 'speakers': speakers}, fh
+        ),
+        mode='w'
+    )
+
+XRAY_COORDCOLS = [
+    'UL_x', 'UL_y', 'LL_x', 'LL_y', 'T1_x', 'T1_y', 'T2_x', 'T2_y',
+    'T3_x', 'T3_y', 'T4_x', 'T4_y', 'MI_x', 'MI_y', 'MM_x', 'MM_y'
+]
+
+# Landmark DataFrames of speakers, keyed on the speaker directory.
+_landmark_cache = {}
+_landmark_lock = threading.Lock()
+
+def _file_stamp(fname):
+    st = os.stat(fname)
+    return (st.st_mtime_ns, st.st_size)
+
+def load_xray_landmarks(datadir, speaker, spkrpath=None):
+    '''Return a DataFrame of the palate and pharynx landmarks of speaker,
+in mm, with a categorical 'landmark' column. The landmark files are read from
+spkrpath, which defaults to the speaker directory in datadir. The landmark
+files are parsed only once per speaker, or again if they change. The returned
+DataFrame is shared by all callers and should not be modified.'''
+    if spkrpath is None:
+        spkrpath = os.path.join(datadir, speaker)
+    palfile = os.path.join(spkrpath, 'PAL.DAT')
+    phafile = os.path.join(spkrpath, 'PHA.DAT')
+    key = os.path.abspath(spkrpath)
+    stamps = (_file_stamp(palfile), _file_stamp(phafile))
+    with _landmark_lock:
+        cached = _landmark_cache.get(key)
+    if cached is not None and cached[0] == stamps:
+        return cached[1]
+    pal = np.loadtxt(palfile, dtype=np.float64, ndmin=2)
+    pha = np.loadtxt(phafile, dtype=np.float64, ndmin=2)
+    xy = np.concatenate([pal, pha]) * 1e-3   # Convert to mm.
+    landmarkdf = pd.DataFrame(
+        {
+            'x': xy[:, 0],
+            'y': xy[:, 1],
+            'landmark': pd.Categorical.from_codes(
+                np.repeat([0, 1], [len(pal), len(pha)]),
+                categories=['palate', 'pharynx']
+            )
+        },
+        index=np.concatenate([np.arange(len(pal)), np.arange(len(pha))])
+    )
+    with _landmark_lock:
+        _landmark_cache[key] = (stamps, landmarkdf)
+    return landmarkdf
+
+def read_txy(articfile, badval=1000000, cache=None):
+    '''Read a .txy file and return a DataFrame with time in seconds and
+coordinates in mm, and bad values (badval) replaced by NaN. If cache is a
+ColumnarCache the converted data are read from and stored in it.'''
+    key = ('txy', badval)
+    if cache is not None:
+        articdf = cache.load(articfile, key)
+        if articdf is not None:
+            return articdf
+    vals = pd.read_csv(
+        articfile,
+        sep='\t',
+        header=None,
+        na_values=badval,
+        dtype=np.float64
+    ).values
+    # Convert time to seconds and coordinates to mm in one operation.
+    scale = np.full(vals.shape[1], 1e-3)
+    scale[0] = 1e-6
+    articdf = pd.DataFrame(vals * scale, columns=['sec'] + XRAY_COORDCOLS)
+    if cache is not None:
+        cache.save(articfile, articdf, key)
+    return articdf
+
+def load_xray_files(datadir, speaker, utterance, badval=1000000, cache=None,
+                    spkrpath=None):
     '''Load files from xray database related to a speaker and utterance.
 Return as DataFrames. Convert the time data to seconds and distance
-measurements to mm. Also remove bad values (1000000).'''
-    spkrpath = os.path.join(datadir, speaker)
+measurements to mm. Also remove bad values (1000000). The files are read from
+spkrpath, which defaults to the speaker directory in datadir. If cache is a
+ColumnarCache the converted articulator data are cached in it. Landmark data
+are cached per speaker by load_xray_landmarks().'''
+    if spkrpath is None:
+        spkrpath = os.path.join(datadir, speaker)
     rate, au = scipy.io.wavfile.read(os.path.join(spkrpath, utterance + '.wav'))
 
     # Load the tongue data
-    articfile = os.path.join(spkrpath, utterance + '.txy')
-    coordcols = [
-        'UL_x', 'UL_y', 'LL_x', 'LL_y', 'T1_x', 'T1_y', 'T2_x', 'T2_y',
-        'T3_x', 'T3_y', 'T4_x', 'T4_y', 'MI_x', 'MI_y', 'MM_x', 'MM_y'
-    ]
-    articdf = pd.read_csv(
-            articfile,
-            sep='\t',
-            na_values=badval,
-            names=['sec'] + coordcols
+    articdf = read_txy(
+        os.path.join(spkrpath, utterance + '.txy'), badval=badval, cache=cache
     )
-    articdf['sec'] *= 1e-6 # Convert to seconds
 
-    # Load the palate data.
-    palfile = os.path.join(spkrpath, 'PAL.DAT')
-    paldf = pd.read_csv(palfile, sep='\s+', header=None, names=['x', 'y'])
+    # Load the palate and pharynx data.
+    landmarkdf = load_xray_landmarks(datadir, speaker, spkrpath=spkrpath)
 
-    # Load the pharynx data.
-    phafile = os.path.join(spkrpath, 'PHA.DAT')
-    phadf = pd.read_csv(phafile, sep='\s+', header=None, names=['x', 'y'])
-
-    landmarkdf = pd.concat([
-        paldf.assign(landmark = pd.Series(['palate'] * len(paldf))),
-        phadf.assign(landmark = pd.Series(['pharynx'] * len(phadf)))
-    ])
-    
-    # Convert all coordinates to mm.
-    articdf[coordcols] *= 1e-3
-    landmarkdf.loc[:, ['x','y']] *= 1e-3
-
-    # Calculate velocities for all coordinate columns and add as <coordinate>_vel columns.
-    articdf = articdf.join(articdf[coordcols].diff(), rsuffix='_vel')
-    
     return (rate, au, articdf, landmarkdf)
+
+class XrayDataLoader(UtteranceCache):
+    '''A class for loading X-ray microbeam data, with the same interface as
+ema.EmaEcogDataLoader.
+
+Utterances have no repetitions, so rep is ignored and the repetition lists are
+empty. Converted .txy data are cached in binary form in cachedir, unless
+use_cache is False. cachedir defaults to a directory for datadir in the user's
+cache directory, or to a '.articuvis_cache' directory in datadir if
+cache_in_datadir is True. Loaded utterances are kept in an in-memory LRU cache; see
+datacache.UtteranceCache.'''
+    def __init__(self, datadir, cachedir=None, use_cache=True,
+                 cache_in_datadir=False, utt_cache_size=8, *args, **kwargs):
+        super(XrayDataLoader, self).__init__(
+            utt_cache_size=utt_cache_size, *args, **kwargs
+        )
+        self.datadir = datadir
+        if cachedir is None:
+            cachedir = default_cachedir(datadir, cache_in_datadir)
+        self.cache = ColumnarCache(cachedir) if use_cache is True else None
+        # Speaker directories can be anywhere below datadir, so the
+        # directory of each speaker is kept in speaker_paths.
+        self.speaker_map, self.speaker_paths = walk_xray_datadir(
+            datadir, cachedir=cachedir, use_cache=use_cache, with_paths=True
+        )
+
+    def utt_fname(self, speakerid, dataname, ext):
+        '''Return the name of an X-ray microbeam speaker utterance file.'''
+        return os.path.join(
+            self.speaker_paths[speakerid], '{}.{}'.format(dataname, ext)
+        )
+
+    def utt_key(self, speakerid, dataname, rep, channel):
+        '''Return the utt_cache key for an utterance and audio channel.'''
+        return (speakerid, dataname, '', int(channel))
+
+    def get_audio(self, speakerid, dataname, rep, channel):
+        '''Read an X-ray microbeam speaker audio file. Return sample rate and
+audio data as a numpy array. The file is memory-mapped, and the channel is a
+view of it, not a copy. Mono files ignore channel.'''
+        rate, au = scipy.io.wavfile.read(
+            self.utt_fname(speakerid, dataname, 'wav'), mmap=True
+        )
+        if au.ndim > 1:
+            au = au[:, channel]
+        return (rate, au)
+
+    def get_speaker_utt(self, speakerid, dataname, rep=None):
+        '''Read an X-ray microbeam speaker utterance into a DataFrame.'''
+        return read_txy(
+            self.utt_fname(speakerid, dataname, 'txy'), cache=self.cache
+        )
+
+    def get_palate_trace(self, speakerid, trange=None, xdim='x', ydim='y', **kwargs):
+        '''Return a landmark dataframe of columns 'x' and 'y', plus 'landmark'
+column, with the palate and pharynx traces of a speaker. xdim and ydim select
+the columns used for 'x' and 'y'; the landmarks have no z dimension, which is
+NaN. trange is ignored.'''
+        landmarkdf = load_xray_landmarks(
+            self.datadir, speakerid, spkrpath=self.speaker_paths[speakerid]
+        )
+        return pd.DataFrame(
+            {
+                'x': landmarkdf[xdim] if xdim in landmarkdf else np.nan,
+                'y': landmarkdf[ydim] if ydim in landmarkdf else np.nan,
+                'landmark': landmarkdf.landmark
+            },
+            index=landmarkdf.index
+        )
+
+    def prefetch_neighbors(self, speakerid, dataname, rep, channel, next_utt=False):
+        '''Prefetch the utterances before and after an utterance, since there
+are no repetitions. next_utt is ignored.'''
+        utts = self.get_utterance_list_for_speaker(speakerid)
+        if dataname in utts:
+            idx = utts.index(dataname)
+            for nidx in (idx + 1, idx - 1):
+                if 0 <= nidx < len(utts):
+                    self.prefetch(speakerid, utts[nidx], '', channel)
+
+    def get_speaker_list(self, sorted=True):
+        '''Return a list of speakers, sorted by speaker number.'''
+        spkrs = list(self.speaker_map.keys())
+        if sorted is True:
+            spkrs.sort(key=lambda x: int(x[2:]))
+        return spkrs
+
+    def get_utterance_list_for_speaker(self, speakerid, sorted=True):
+        '''Return a list of utterances for a speaker.'''
+        utts = list(self.speaker_map[speakerid])
+        if sorted is True:
+            utts.sort()
+        return utts
+
+    def get_rep_list_for_speaker_utterance(self, speakerid, utt, sorted=True):
+        '''Return an empty list, since utterances have no repetitions.'''
+        return []
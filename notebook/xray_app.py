@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+
+import sys
+from pyqtgraph.Qt import QtGui
+from articapp import ArticApp
+from ema_widget import DataLoaderWidget
+from xray import XrayDataLoader
+
+app = QtGui.QApplication(sys.argv)
+
+xraybase = sys.argv[1]
+
+data_load_widget = DataLoaderWidget(
+    xraybase, data_loader=XrayDataLoader(xraybase)
+)
+
+win = ArticApp(data_loader=data_load_widget)
+
+win.resize(800,700)
+win.setWindowTitle('X-ray microbeam')
+
+win.show()
+sys.exit(app.exec_())